@@ -1,68 +1,1285 @@
+import contextlib
 import datetime
+import fnmatch
+import functools
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from optparse import OptionParser
-import glob
+import gzip
+import hashlib
+import heapq
 import http.client
+import http.server
+import json
+import shutil
 import urllib
 import zipfile
-from io import BytesIO
+from xml.dom.minicompat import NodeList
 from xml.dom.minidom import getDOMImplementation
-from xml.etree import cElementTree
+from xml.sax.saxutils import escape, unescape
+try:
+    from xml.etree import cElementTree
+except ImportError:
+    # Removed in Python 3.9, ElementTree uses the C parser on its own
+    from xml.etree import ElementTree as cElementTree
 import re
+import sqlite3
+import sys
+import threading
 import time
 import logging
 import traceback
-import tvdb_api
 
 
 
+LOGGER = logging.getLogger("epgData2XMLTV")
+
+
 def log():
-    return logging.getLogger("epgData2XMLTV")
+    return LOGGER
+
+
+def tvdb():
+    # The thetvdb.com client library, imported on first use: conversions
+    # without episode lookups (see App.TVDB) start without it
+    import tvdb_api
+    return tvdb_api
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=8192)
+def xmltv_time(value, timeoffset):
+    # '2020-01-31 20:15:00' -> '20200131201500 +0100'; start times repeat across channels
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d%H%M%S '+timeoffset)
+
+
+ACTOR_NAME = re.compile(r"(.*?)\(.*?\)")
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_names(value):
+    # 'Name|Name' (d32 country, d34 moderator, d35 studio guest, d36 regisseur) -> ('Name', 'Name')
+    if len(value) == 0:
+        return ()
+    return tuple(sys.intern(name) for name in value.split('|'))
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_actors(value):
+    # 'Name (Role) - Name (Role)' (d37) -> ('Name', 'Name'), without the
+    # roles; an actor with an empty name is left out
+    names = []
+    if len(value) == 0:
+        return ()
+    for name in value.split(') - '):
+        name = name + ")"
+        actor_name = ACTOR_NAME.search(name)
+        if actor_name is None:
+            names.append(sys.intern(name))
+        elif len(actor_name.group(1).strip()) > 0:
+            names.append(sys.intern(actor_name.group(1).strip()))
+    return tuple(names)
+
+
+class ProgrammeRecord:
+    # The fields of one <data> row of a day file, read in a single pass over its children.
+    FIELDS = {
+        'd0': 'broadcast_id',
+        'd2': 'tvchannel_id',
+        'd4': 'starttime',
+        'd5': 'endtime',
+        'd7': 'tvshow_length',
+        'd9': 'primetime',
+        'd10': 'category_id',
+        'd16': 'age_marker',
+        'd19': 'title',
+        'd20': 'subtitle',
+        'd21': 'comment_long',
+        'd25': 'genreid',
+        'd26': 'sequence',
+        'd30': 'tvd_total_value',
+        'd32': 'country',
+        'd33': 'year',
+        'd34': 'moderator',
+        'd35': 'studio_guest',
+        'd36': 'regisseur',
+        'd37': 'actor',
+        'd40': 'image_big',
+    }
+    __slots__ = tuple(FIELDS.values())
+
+    def __init__(self):
+        # Like findtext: None for a missing field, '' for an empty one
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    @classmethod
+    def from_element(cls, elem, channel_ids=None):
+        # Returns None as soon as d2 names a channel that is not in channel_ids
+        record = cls()
+        fields = cls.FIELDS
+        for child in elem:
+            name = fields.get(child.tag)
+            if name is not None:
+                value = child.text or ''
+                if name == 'tvchannel_id' and channel_ids is not None and value not in channel_ids:
+                    return None
+                setattr(record, name, value)
+        if record.tvchannel_id is None:
+            return None
+        return record
+
+    @classmethod
+    def from_row(cls, row, strings):
+        # row holds string ids in the order of __slots__, see ProgrammeStore
+        record = cls.__new__(cls)
+        for name, value in zip(cls.__slots__, row):
+            setattr(record, name, None if value is None else strings[value])
+        return record
+
+
+def iter_rows(path):
+    # The <data> elements of a day file, cleared after use
+    context = cElementTree.iterparse(path, events=("start", "end",))
+    context = iter(context)
+    event, root = next(context)
+    for event, elem in context:
+        if event == "end" and elem.tag == 'data':
+            yield elem
+            root.clear()
+
+
+class ProgrammeStore:
+    # The rows of each day file parsed once into a SQLite database next to
+    # the other caches. Every distinct text is kept once in the strings table,
+    # the programmes table holds string ids in file order and is indexed by
+    # channel and start time. A database is rebuilt when its day file changed.
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def store_path(self, xml_file):
+        return '{}/{}.db'.format(self.path, os.path.basename(xml_file))
+
+    def source(self, xml_file):
+        stat = os.stat(xml_file)
+        return '{}:{}:{}'.format(self.VERSION, stat.st_mtime_ns, stat.st_size)
+
+    def build(self, xml_file):
+        log().debug('ProgrammeStore.build: %s', xml_file)
+        store_path = self.store_path(xml_file)
+        partial_path = store_path + '.part'
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        source = self.source(xml_file)
+
+        strings = {}
+        connection = sqlite3.connect(partial_path)
+        try:
+            columns = ProgrammeRecord.__slots__
+            connection.execute('CREATE TABLE meta (source TEXT)')
+            connection.execute('CREATE TABLE strings (id INTEGER PRIMARY KEY, value TEXT)')
+            connection.execute('CREATE TABLE programmes (row INTEGER PRIMARY KEY, {})'.format(
+                ', '.join('{} INTEGER'.format(column) for column in columns)))
+            insert = 'INSERT INTO programmes ({}) VALUES ({})'.format(
+                ', '.join(columns), ', '.join('?' * len(columns)))
+            rows = []
+            for elem in iter_rows(xml_file):
+                record = ProgrammeRecord.from_element(elem)
+                if record is None:
+                    continue
+                row = []
+                for name in columns:
+                    value = getattr(record, name)
+                    if value is not None:
+                        value = strings.setdefault(value, len(strings))
+                    row.append(value)
+                rows.append(row)
+            connection.executemany(insert, rows)
+            connection.executemany('INSERT INTO strings (id, value) VALUES (?, ?)',
+                                   [(string_id, value) for value, string_id in strings.items()])
+            connection.execute('CREATE INDEX programmes_channel ON programmes (tvchannel_id, starttime)')
+            connection.execute('INSERT INTO meta (source) VALUES (?)', (source,))
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(partial_path, store_path)
+
+    def open(self, xml_file):
+        # A connection to the up to date database of xml_file
+        store_path = self.store_path(xml_file)
+        if os.path.exists(store_path):
+            connection = sqlite3.connect(store_path)
+            try:
+                if connection.execute('SELECT source FROM meta').fetchone()[0] == self.source(xml_file):
+                    return connection
+            except sqlite3.DatabaseError:
+                pass
+            connection.close()
+        self.build(xml_file)
+        return sqlite3.connect(store_path)
+
+    def records(self, xml_file, channel_ids=None):
+        # ProgrammeRecords in file order, of channel_ids only if given.
+        # Returns (total rows, records).
+        connection = self.open(xml_file)
+        try:
+            strings = {}
+            channel_strings = []
+            for string_id, value in connection.execute('SELECT id, value FROM strings'):
+                strings[string_id] = sys.intern(value)
+                if channel_ids is not None and value in channel_ids:
+                    channel_strings.append(string_id)
+            total = connection.execute('SELECT COUNT(*) FROM programmes').fetchone()[0]
+            query = 'SELECT {} FROM programmes'.format(', '.join(ProgrammeRecord.__slots__))
+            if channel_ids is not None:
+                query += ' WHERE tvchannel_id IN ({})'.format(', '.join(str(string_id) for string_id in channel_strings))
+            query += ' ORDER BY row'
+            records = [ProgrammeRecord.from_row(row, strings) for row in connection.execute(query)]
+        finally:
+            connection.close()
+        return total, records
+
+    def episodes(self, xml_file, channel_ids=None):
+        # The distinct (title, subtitle) of the episodes of xml_file (sequence
+        # not 0, a subtitle), of channel_ids only if given. The rows are
+        # compared on their string ids, only the distinct pairs are resolved.
+        connection = self.open(xml_file)
+        try:
+            ids = dict((value, string_id) for string_id, value in
+                       connection.execute('SELECT id, value FROM strings WHERE value IN (?, ?)', ('0', '')))
+            query = 'SELECT DISTINCT title, subtitle FROM programmes WHERE sequence <> ? AND subtitle <> ?'
+            parameters = [ids.get('0', -1), ids.get('', -1)]
+            if channel_ids is not None:
+                query += ' AND tvchannel_id IN (SELECT id FROM strings WHERE value IN ({}))'.format(
+                    ', '.join('?' * len(channel_ids)))
+                parameters += list(channel_ids)
+            query = 'SELECT title.value, subtitle.value FROM ({}) AS pairs ' \
+                    'JOIN strings AS title ON title.id = pairs.title ' \
+                    'JOIN strings AS subtitle ON subtitle.id = pairs.subtitle'.format(query)
+            return set(connection.execute(query, parameters))
+        finally:
+            connection.close()
+
+    def prune(self, xml_files):
+        # Removes the databases of day files that are gone
+        names = set(os.path.basename(xml_file) + '.db' for xml_file in xml_files)
+        for filename in os.listdir(self.path):
+            if filename not in names:
+                try:
+                    os.remove('{}/{}'.format(self.path, filename))
+                except OSError:
+                    pass
+
+
+class InputManifest:
+    # The files in the input path by role: day packages are recognized by their
+    # date prefix (20200131_20200131_de_qy.xml), include tables and undated
+    # xml files by the tags of their first row.
+    ROLES = [('ch', 'channel'), ('ca', 'category'), ('g', 'genre'), ('d', 'programme')]
+    INCLUDES = {'channel': 'channel_y.xml', 'category': 'category.xml', 'genre': 'genre.xml'}
+
+    def __init__(self, path, dateformat):
+        self.path = path
+        self.dateformat = dateformat
+        self.scan()
+
+    def scan(self):
+        self.dated_files = {}
+        self.day_files = []
+        self.includes = {}
+        self.partial_files = []
+        for filename in sorted(os.listdir(self.path)):
+            if filename.endswith('.part'):
+                self.partial_files.append(filename)
+                continue
+            date = self.date(filename)
+            if date is not None:
+                self.dated_files[filename] = date
+            if not filename.endswith('.xml'):
+                continue
+            if filename in self.dated_files:
+                self.day_files.append(filename)
+                continue
+            role = self.peek_role('{}/{}'.format(self.path, filename))
+            if role == 'programme':
+                self.day_files.append(filename)
+            elif role is not None and (role not in self.includes or filename == self.INCLUDES[role]):
+                self.includes[role] = filename
+
+    def date(self, filename):
+        # The date of a day package by its prefix, None for other files
+        try:
+            return datetime.datetime.strptime(filename.split('_')[0], self.dateformat)
+        except ValueError:
+            return None
+
+    def peek_role(self, path):
+        # Role by the tag of the first field in the first row, without reading the rest
+        try:
+            depth = 0
+            for event, elem in cElementTree.iterparse(path, events=("start",)):
+                depth += 1
+                if depth == 3:
+                    for prefix, role in self.ROLES:
+                        if elem.tag.startswith(prefix):
+                            return role
+                    return None
+        except cElementTree.ParseError:
+            pass
+        return None
+
+    def days(self):
+        return ['{}/{}'.format(self.path, filename) for filename in self.day_files]
+
+    def include(self, role):
+        return '{}/{}'.format(self.path, self.includes.get(role, self.INCLUDES[role]))
+
+    def fetched(self, date):
+        prefix = date.strftime(self.dateformat)
+        for filename in self.dated_files:
+            if filename.startswith(prefix):
+                return True
+        return False
+
+    def remove(self, filename):
+        os.remove('{}/{}'.format(self.path, filename))
+        self.dated_files.pop(filename, None)
+        if filename in self.partial_files:
+            self.partial_files.remove(filename)
+        if filename in self.day_files:
+            self.day_files.remove(filename)
+
+
+def episode_key(title, subtitle):
+    # (series, episode) as looked up on thetvdb.com
+    return title.split(' - ')[0], subtitle.split(' / ')[0]
+
+
+class DownloadState:
+    # Per package (the include package, a day package by its date): the
+    # validators (ETag, Last-Modified, Content-Length) and the content hash of
+    # the last complete download, and those of an interrupted download whose
+    # spool file is kept to be resumed with a Range request.
+
+    def __init__(self, path):
+        self.path = path
+        self.filename = path + '.json'
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, key):
+        with self.lock:
+            return dict(self.entries.get(key, {}))
+
+    def update(self, key, **values):
+        with self.lock:
+            self.entries.setdefault(key, {}).update(values)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
+
+    def spool_path(self, key):
+        return '{}/{}.zip.part'.format(self.path, key)
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+        if os.path.exists(self.spool_path(key)):
+            os.remove(self.spool_path(key))
+
+    def save(self):
+        with self.lock:
+            with open(self.filename + '.part', 'w') as f:
+                json.dump(self.entries, f, indent=2)
+        os.replace(self.filename + '.part', self.filename)
+
+
+class XMLTVWriter:
+    # Writes the <tv> document incrementally, one top level element at a time,
+    # using the same layout as toprettyxml(indent="\t", newl="\n"). The
+    # document is renamed into place on close, readers never see a partial one.
+
+    def __init__(self, path, compress=False):
+        self.path = path
+        if compress:
+            self.file_handle = gzip.open(path + '.part', "wt", encoding="utf-8")
+        else:
+            self.file_handle = open(path + '.part', "w", encoding="utf-8")
+        self.count = 0
+
+    def open(self, attributes):
+        self.file_handle.write('<?xml version="1.0" encoding="utf-8" standalone="yes"?>')
+        self.file_handle.write('<tv')
+        for name, value in attributes:
+            self.file_handle.write(' {}="{}"'.format(name, escape(value, {'"': "&quot;"})))
+        self.file_handle.write('>\n')
+
+    def write(self, element):
+        element.writexml(self.file_handle, "\t", "\t", "\n")
+        self.count += 1
+
+    ELEMENT = re.compile(r'\t<(?:channel id|programme channel)="([^"]*)"(?: start="(\d{14})[^"]*" stop="(\d{14}))?')
+
+    def write_fragment(self, fragment_path, count, channel_ids=None, window=None):
+        # Copies a fragment, optionally only the channels and programmes of
+        # channel_ids running within window (start, stop)
+        with open(fragment_path, encoding="utf-8", newline='') as f:
+            if channel_ids is None and window is None:
+                shutil.copyfileobj(f, self.file_handle)
+                self.count += count
+                return
+
+            keep = False
+            for line in f:
+                # Only top level elements start a line with "\t<", text has "<" escaped
+                if line.startswith('\t<') and not line.startswith('\t</'):
+                    match = self.ELEMENT.match(line)
+                    keep = match is not None \
+                        and (channel_ids is None or unescape(match.group(1)) in channel_ids) \
+                        and (window is None or match.group(2) is None
+                             or (match.group(3) > window[0] and match.group(2) < window[1]))
+                    if keep:
+                        self.count += 1
+                if keep:
+                    self.file_handle.write(line)
+
+    def write_programmes(self, programmes, window=None):
+        # Writes (key, text) pairs, see merge_programmes, of programmes
+        # running within window (start, stop) only if given
+        for key, text in programmes:
+            if window is None or (key[2][:14] > window[0] and key[1][:14] < window[1]):
+                self.file_handle.write(text)
+                self.count += 1
+
+    def close(self):
+        self.file_handle.write('</tv>\n')
+        self.file_handle.close()
+        os.replace(self.path + '.part', self.path)
+
+    def discard(self):
+        self.file_handle.close()
+        os.remove(self.path + '.part')
+
+
+class FragmentWriter:
+    # Writes elements without the surrounding <tv> document, see ConversionCache.
+    # With keys, the (channel, start, stop, broadcast id) of every programme
+    # goes to a .keys file alongside, one tab separated line per element; see
+    # read_programmes.
+
+    def __init__(self, path, keys=False):
+        self.path = path
+        self.file_handle = open(path + '.part', "w", encoding="utf-8")
+        self.keys_handle = open(path + '.keys.part', "w", encoding="utf-8") if keys else None
+        self.count = 0
+
+    def write(self, element, exclude=(), key=None):
+        # exclude: tag names of child elements to leave out
+        if self.keys_handle is not None:
+            self.keys_handle.write('\t'.join(key) + '\n')
+        if len(exclude) == 0:
+            element.writexml(self.file_handle, "\t", "\t", "\n")
+        else:
+            children = element.childNodes
+            element.childNodes = NodeList([child for child in children if child.nodeName not in exclude])
+            try:
+                element.writexml(self.file_handle, "\t", "\t", "\n")
+            finally:
+                element.childNodes = children
+        self.count += 1
+
+    def close(self):
+        self.file_handle.close()
+        if self.keys_handle is not None:
+            self.keys_handle.close()
+            os.replace(self.path + '.keys.part', self.path + '.keys')
+        os.replace(self.path + '.part', self.path)
+
+    def discard(self):
+        self.file_handle.close()
+        os.remove(self.path + '.part')
+        if self.keys_handle is not None:
+            self.keys_handle.close()
+            os.remove(self.path + '.keys.part')
+
+
+def read_programmes(fragment_path):
+    # (key, text) of each programme of a fragment written with keys
+    with open(fragment_path, encoding="utf-8", newline='') as f, \
+            open(fragment_path + '.keys', encoding="utf-8") as keys:
+        key = None
+        lines = []
+        for line in f:
+            # Text has "<" escaped, so only an element starts a line with "\t<programme"
+            if line.startswith('\t<programme'):
+                if key is not None:
+                    yield key, ''.join(lines)
+                key = tuple(keys.readline().rstrip('\n').split('\t'))
+                lines = []
+            lines.append(line)
+        if key is not None:
+            yield key, ''.join(lines)
+
+
+LENGTH = re.compile(r'<length units="minutes">[^<]*</length>')
+
+
+def cut_programme(key, text, stop):
+    # The programme (key, text) ending at stop instead, with its length updated
+    channel, start, old_stop, broadcast_id = key
+    text = text.replace(' stop="{}"'.format(old_stop), ' stop="{}"'.format(stop), 1)
+    duration = datetime.datetime.strptime(stop[:14], '%Y%m%d%H%M%S') \
+        - datetime.datetime.strptime(start[:14], '%Y%m%d%H%M%S')
+    minutes = int(duration.total_seconds()) // 60
+    text = LENGTH.sub('<length units="minutes">{}</length>'.format(minutes), text, 1)
+    return (channel, start, stop, broadcast_id), text
+
+
+def merge_programmes(fragment_paths, stats, channel_ids=None):
+    # Merges fragments sorted by (channel, start, stop, broadcast id) into one
+    # stream sorted the same way. Per channel, a broadcast id (if any) or
+    # start/stop seen before is a duplicate and dropped. A programme starting
+    # before the previous one stops is an overlap: it is dropped when it
+    # starts at the same time or ends within the previous one, otherwise the
+    # previous one is cut to end at its start. Only one programme is held
+    # back at a time.
+    programmes = heapq.merge(*[read_programmes(path) for path in fragment_paths], key=lambda p: p[0])
+    pending = None
+    seen = set()
+    for key, text in programmes:
+        channel, start, stop, broadcast_id = key
+        if channel_ids is not None and channel not in channel_ids:
+            continue
+        if pending is not None and pending[0][0] != channel:
+            yield pending
+            pending = None
+            seen = set()
+
+        if (len(broadcast_id) > 0 and broadcast_id in seen) \
+                or (pending is not None and pending[0][1:3] == (start, stop)):
+            stats['duplicates'] += 1
+            continue
+        if len(broadcast_id) > 0:
+            seen.add(broadcast_id)
+
+        if pending is not None and start < pending[0][2]:
+            stats['overlaps'] += 1
+            if start == pending[0][1] or stop <= pending[0][2]:
+                continue
+            pending = cut_programme(pending[0], pending[1], start)
+
+        if pending is not None:
+            yield pending
+        pending = (key, text)
+
+    if pending is not None:
+        yield pending
+
+
+class FragmentSet:
+    # Renders every element once into one fragment per variant, a variant
+    # being the child elements to leave out, see OutputProfile.
+
+    def __init__(self, fragment_paths):
+        self.writers = [(variant, FragmentWriter(path, keys=True)) for variant, path in fragment_paths.items()]
+        self.count = 0
+
+    def write(self, element, key):
+        for variant, writer in self.writers:
+            writer.write(element, variant, key)
+        self.count += 1
+
+    def close(self):
+        for variant, writer in self.writers:
+            writer.close()
+
+    def discard(self):
+        for variant, writer in self.writers:
+            writer.discard()
+
+
+class ConversionCache:
+    # Rendered <programme> fragments per day file and variant. A fragment is
+    # reused while the day file (mtime/size, else content hash) and the
+    # conversion context (include tables, channel filter, time offset,
+    # variants) are unchanged.
+
+    def __init__(self, path, context, variants=((),)):
+        self.path = path
+        self.context = context
+        self.variants = variants
+        self.index_filename = '{}/{}'.format(path, 'fragments.json')
+        os.makedirs(path, exist_ok=True)
+        try:
+            with open(self.index_filename) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        self.hits = 0
+        self.misses = 0
+
+    def fragment_path(self, xml_file, variant=()):
+        return '{}/{}{}.frag'.format(self.path, os.path.basename(xml_file), ''.join('-' + tag for tag in variant))
+
+    def fragment_paths(self, xml_file):
+        return dict((variant, self.fragment_path(xml_file, variant)) for variant in self.variants)
+
+    def lookup(self, xml_file):
+        # Returns the element count of valid fragments, None otherwise
+        entry = self.index.get(os.path.basename(xml_file))
+        if entry is not None and entry['context'] == self.context \
+                and all(os.path.exists(path) and os.path.exists(path + '.keys')
+                        for path in self.fragment_paths(xml_file).values()):
+            stat = os.stat(xml_file)
+            if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                self.hits += 1
+                return entry['count']
+            if entry['size'] == stat.st_size and entry['hash'] == file_hash(xml_file):
+                entry['mtime'] = stat.st_mtime
+                self.hits += 1
+                return entry['count']
+        self.misses += 1
+        return None
+
+    def store(self, xml_file, count):
+        stat = os.stat(xml_file)
+        self.index[os.path.basename(xml_file)] = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                                                  'hash': file_hash(xml_file), 'context': self.context,
+                                                  'count': count}
+
+    def close(self, xml_files):
+        # Forget fragments of day files that are gone
+        names = set(os.path.basename(xml_file) for xml_file in xml_files)
+        for name in list(self.index):
+            if name not in names:
+                del self.index[name]
+        for filename in os.listdir(self.path):
+            if filename.endswith(('.frag', '.keys')) and filename.split('.xml')[0] + '.xml' not in names:
+                try:
+                    os.remove('{}/{}'.format(self.path, filename))
+                except OSError:
+                    pass
+
+        with open(self.index_filename + '.part', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.index_filename + '.part', self.index_filename)
+        log().info('conversion cache: {} hits, {} misses.'.format(self.hits, self.misses))
+
+
+class EpisodeCache:
+    # Persistent thetvdb.com episode lookups keyed by (series, episode name).
+    # Misses (show or episode not found) are cached with a shorter ttl.
+    TTL = 30 * 24 * 3600
+    NEGATIVE_TTL = 24 * 3600
+    MAX_ENTRIES = 50000
+    COMMIT_INTERVAL = 100
+
+    def __init__(self, path):
+        # Conversion workers share the file, see App.convert_files
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS episodes ('
+                                'series TEXT NOT NULL, episode TEXT NOT NULL, '
+                                'season INTEGER, number INTEGER, '
+                                'fetched REAL NOT NULL, used REAL NOT NULL, '
+                                'PRIMARY KEY (series, episode))')
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+
+    def get(self, series, episode):
+        # Returns None on a miss, (season, number) on a hit and
+        # (None, None) on a cached "not found".
+        now = time.time()
+        row = self.connection.execute('SELECT season, number, fetched FROM episodes WHERE series=? AND episode=?',
+                                      (series, episode)).fetchone()
+        if row is not None:
+            season, number, fetched = row
+            ttl = self.TTL if season is not None else self.NEGATIVE_TTL
+            if fetched + ttl > now:
+                self.connection.execute('UPDATE episodes SET used=? WHERE series=? AND episode=?',
+                                        (now, series, episode))
+                self.written()
+                self.hits += 1
+                return season, number
+        self.misses += 1
+        return None
+
+    def put(self, series, episode, season, number):
+        now = time.time()
+        self.connection.execute('INSERT OR REPLACE INTO episodes VALUES (?, ?, ?, ?, ?, ?)',
+                                (series, episode, season, number, now, now))
+        self.written()
+
+    def written(self):
+        # Commits every COMMIT_INTERVAL writes. The conversion workers commit
+        # every write, so none of them holds the write lock of the shared file.
+        self.writes += 1
+        if self.writes % self.COMMIT_INTERVAL == 0:
+            self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+    def flush(self):
+        # Evict the least recently used entries above MAX_ENTRIES
+        self.connection.execute('DELETE FROM episodes WHERE rowid IN ('
+                                'SELECT rowid FROM episodes ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                                (self.MAX_ENTRIES,))
+        self.connection.commit()
+        log().info('tvdb cache: {} hits, {} misses.'.format(self.hits, self.misses))
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class ChannelFilter:
+    # The channels to convert, one entry per line: a channel name (ch0) or id
+    # (ch4), a glob pattern like "Sky *" or a regular expression after "re:".
+    # Empty lines and lines starting with "#" are ignored.
+
+    def __init__(self, lines):
+        self.entries = set()
+        self.patterns = []
+        for line in lines:
+            if len(line.strip()) == 0 or line.startswith('#'):
+                continue
+            if line.startswith('re:'):
+                self.patterns.append(re.compile(line[3:]))
+            elif '*' in line or '?' in line:
+                self.patterns.append(re.compile(fnmatch.translate(line)))
+            else:
+                self.entries.add(line)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            return cls(f.read().splitlines())
+
+    def matches(self, channel_id, channel_name):
+        if channel_name in self.entries or channel_id in self.entries:
+            return True
+        for pattern in self.patterns:
+            if pattern.match(channel_name):
+                return True
+        return False
+
+
+class OutputProfile:
+    # An additional output document: a time window from now on, a subset of
+    # the channels (ChannelFilter entries) and the elements to leave out.
+    EXCLUDES = [('credits', 'credits'), ('descriptions', 'desc'), ('icons', 'icon')]
+
+    def __init__(self, name, hours=None, channels=None, credits=True, descriptions=True, icons=True, gzip=False):
+        self.name = name
+        self.hours = hours
+        self.channel_filter = ChannelFilter(channels) if channels is not None else None
+        self.gzip = gzip
+        options = {'credits': credits, 'descriptions': descriptions, 'icons': icons}
+        self.exclude = tuple(tag for option, tag in self.EXCLUDES if not options[option])
+
+    @classmethod
+    def load(cls, path):
+        # A json list of objects with the arguments of OutputProfile
+        with open(path, encoding="utf-8") as f:
+            return [cls(**profile) for profile in json.load(f)]
+
+    def filename(self, output_path):
+        return '{}/{}.xml{}'.format(output_path, self.name, '.gz' if self.gzip else '')
+
+    def window(self):
+        if self.hours is None:
+            return None
+        now = datetime.datetime.now()
+        return now.strftime('%Y%m%d%H%M%S'), (now + datetime.timedelta(hours=self.hours)).strftime('%Y%m%d%H%M%S')
+
+
+class RunReport:
+    # Wall time per stage, counters and per file conversion figures of one
+    # refresh. Written as json and optionally in the Prometheus text format,
+    # e.g. for the textfile collector of the node exporter.
+    PREFIX = 'epgdata2xmltv_'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.succeeded = False
+        self.stages = {}
+        self.counters = {}
+        self.files = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def count(self, name, value=1):
+        # Called from the download and tvdb threads as well
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def file(self, xml_file, **values):
+        with self.lock:
+            self.files.setdefault(os.path.basename(xml_file), {}).update(values)
+
+    def state(self):
+        return {'stages': self.stages, 'counters': self.counters, 'files': self.files}
+
+    def merge(self, state):
+        # Adds the figures of a conversion worker, see convert_worker
+        for name, seconds in state['stages'].items():
+            self.add_time(name, seconds)
+        for name, value in state['counters'].items():
+            self.count(name, value)
+        for filename, values in state['files'].items():
+            self.file(filename, **values)
+
+    def write(self, path, prometheus_path=None):
+        report = {
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'succeeded': self.succeeded,
+        }
+        report.update(self.state())
+        with open(path + '.part', 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        os.replace(path + '.part', path)
+
+        if prometheus_path is not None:
+            with open(prometheus_path + '.part', 'w') as f:
+                f.write(self.prometheus())
+            os.replace(prometheus_path + '.part', prometheus_path)
+
+    def prometheus(self):
+        lines = []
+
+        def metric(name, value, label=None):
+            if label is None:
+                lines.append('{}{} {}'.format(self.PREFIX, name, value))
+            else:
+                lines.append('{}{}{{{}="{}"}} {}'.format(self.PREFIX, name, label[0], label[1], value))
+
+        lines.append('# TYPE {}last_run_timestamp_seconds gauge'.format(self.PREFIX))
+        metric('last_run_timestamp_seconds', int(self.started))
+        lines.append('# TYPE {}last_run_success gauge'.format(self.PREFIX))
+        metric('last_run_success', 1 if self.succeeded else 0)
+        lines.append('# TYPE {}stage_seconds gauge'.format(self.PREFIX))
+        for name, seconds in sorted(self.stages.items()):
+            metric('stage_seconds', '{:.6f}'.format(seconds), ('stage', name))
+        for name, value in sorted(self.counters.items()):
+            lines.append('# TYPE {}{} gauge'.format(self.PREFIX, name))
+            metric(name, value)
+        return '\n'.join(lines) + '\n'
+
+
+class Guide:
+    # One version of the merged guide held in memory: the plain and the gzip
+    # compressed document, a strong ETag and an index of the byte span of
+    # every channel and programme for serving slices without parsing.
+    ELEMENT_START = re.compile(rb'\n\t<(channel|programme)[ />]')
+    CHANNEL = re.compile(rb'<channel id="([^"]*)"')
+    DISPLAY_NAME = re.compile(rb'<display-name[^>]*>([^<]*)</display-name>')
+    PROGRAMME = re.compile(rb'<programme channel="([^"]*)" start="(\d{14})[^"]*" stop="(\d{14})')
+    FOOTER = b'</tv>\n'
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            content = f.read()
+        if path.endswith('.gz'):
+            self.gzip_data = content
+            self.data = gzip.decompress(content)
+        else:
+            self.data = content
+            self.gzip_data = gzip.compress(content)
+        self.etag = '"{}"'.format(hashlib.sha1(self.data).hexdigest())
+
+        # channel id -> span, channel name -> id, channel id -> [(start, stop, span)]
+        self.channels = {}
+        self.channel_names = {}
+        self.programmes = {}
+        starts = [match.start() + 1 for match in self.ELEMENT_START.finditer(self.data)]
+        self.header_end = starts[0] if len(starts) > 0 else len(self.data) - len(self.FOOTER)
+        ends = starts[1:] + [len(self.data) - len(self.FOOTER)]
+        for start, end in zip(starts, ends):
+            line_end = self.data.find(b'\n', start)
+            programme = self.PROGRAMME.match(self.data, start + 1, line_end)
+            if programme is not None:
+                channel_id = unescape(programme.group(1).decode('utf-8'))
+                self.programmes.setdefault(channel_id, []).append(
+                    (programme.group(2).decode(), programme.group(3).decode(), (start, end)))
+                continue
+            channel = self.CHANNEL.match(self.data, start + 1, line_end)
+            if channel is not None:
+                channel_id = unescape(channel.group(1).decode('utf-8'))
+                self.channels[channel_id] = (start, end)
+                name = self.DISPLAY_NAME.search(self.data, start, end)
+                if name is not None:
+                    self.channel_names[unescape(name.group(1).decode('utf-8'))] = channel_id
+
+    def slice(self, channels=None, hours=None):
+        # The guide restricted to channels (ids or names) and to the programmes
+        # running in the next hours
+        if channels is None:
+            channel_ids = set(self.channels)
+        else:
+            channel_ids = set(self.channel_names.get(channel, channel) for channel in channels)
+        if hours is not None:
+            now = datetime.datetime.now()
+            window_start = now.strftime('%Y%m%d%H%M%S')
+            window_end = (now + datetime.timedelta(hours=hours)).strftime('%Y%m%d%H%M%S')
+
+        spans = [self.channels[channel_id] for channel_id in channel_ids if channel_id in self.channels]
+        for channel_id in channel_ids:
+            for start, stop, span in self.programmes.get(channel_id, []):
+                if hours is None or (stop > window_start and start < window_end):
+                    spans.append(span)
+        spans.sort()
+
+        parts = [self.data[:self.header_end]]
+        parts += [self.data[start:end] for start, end in spans]
+        parts.append(self.FOOTER)
+        return b''.join(parts)
+
+
+class GuideServer:
+    # Serves the merged guide over http from memory. The file is loaded again
+    # when it changed on disk, see Guide.
+
+    def __init__(self, path, address, port):
+        self.path = path
+        self.guide = None
+        self.signature = None
+        self.lock = threading.Lock()
+        handler = type('Handler', (GuideRequestHandler,), {'guide_server': self})
+        self.httpd = http.server.ThreadingHTTPServer((address, port), handler)
+
+    def current(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        with self.lock:
+            if (stat.st_mtime, stat.st_size) != self.signature:
+                self.guide = Guide(self.path)
+                self.signature = (stat.st_mtime, stat.st_size)
+                log().info('serving {} ({} bytes).'.format(self.path, len(self.guide.data)))
+            return self.guide
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        log().info('http server listening on {}:{}.'.format(*self.httpd.server_address[:2]))
+
+    def wait(self):
+        self.thread.join()
+
+
+class GuideRequestHandler(http.server.BaseHTTPRequestHandler):
+    # GET /epg.xml[?channels=id,name,...][&hours=24] with ETag, gzip and Range support
+    MAX_HOURS = 24 * 14
+    guide_server = None
+
+    def do_HEAD(self):
+        self.send_guide(False)
+
+    def do_GET(self):
+        self.send_guide(True)
+
+    def log_message(self, format, *args):
+        log().debug('http: ' + format, *args)
+
+    def send_guide(self, send_body):
+        url = urllib.parse.urlparse(self.path)
+        if url.path not in ('/', '/epg.xml'):
+            self.send_error(404)
+            return
+        guide = self.guide_server.current()
+        if guide is None:
+            self.send_error(503, 'No guide generated yet')
+            return
+
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            channels = None
+            if 'channels' in query:
+                channels = [channel for value in query['channels'] for channel in value.split(',') if channel]
+            hours = float(query['hours'][0]) if 'hours' in query else None
+            # Also rejects nan and inf
+            if hours is not None and not 0 < hours <= self.MAX_HOURS:
+                raise ValueError(hours)
+        except ValueError:
+            self.send_error(400, 'Invalid hours')
+            return
+
+        if channels is None and hours is None:
+            data, gzip_data, etag = guide.data, guide.gzip_data, guide.etag
+        else:
+            data = guide.slice(channels, hours)
+            gzip_data = None
+            etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+
+        use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '') and self.headers.get('Range') is None
+        if use_gzip:
+            etag = etag[:-1] + '-gz"'
+
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.end_headers()
+            return
+
+        status = 200
+        headers = [('Content-Type', 'application/xml; charset=utf-8'), ('ETag', etag),
+                   ('Vary', 'Accept-Encoding'), ('Accept-Ranges', 'bytes')]
+        if use_gzip:
+            body = gzip_data if gzip_data is not None else gzip.compress(data)
+            headers.append(('Content-Encoding', 'gzip'))
+        else:
+            body = data
+            byte_range = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            if byte_range is not None and (if_range is None or if_range == etag):
+                span = self.parse_range(byte_range, len(data))
+                if span is None:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                status = 206
+                body = data[span[0]:span[1] + 1]
+                headers.append(('Content-Range', 'bytes {}-{}/{}'.format(span[0], span[1], len(data))))
+
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def parse_range(self, byte_range, length):
+        # A single "bytes=first-last", "bytes=first-" or "bytes=-suffix" range
+        match = re.match(r'bytes=(\d*)-(\d*)$', byte_range.strip())
+        if match is None or match.group(1) == match.group(2) == '':
+            return None
+        if match.group(1) == '':
+            first = max(0, length - int(match.group(2)))
+            last = length - 1
+        else:
+            first = int(match.group(1))
+            last = min(int(match.group(2)), length - 1) if match.group(2) else length - 1
+        if first > last or first >= length:
+            return None
+        return first, last
 
 
 class App:
     INPUT_PATH = 'epgdata_files'
     OUTPUT_PATH = 'output'
+    CACHE_PATH = 'cache'
+    CHANNELFILTER = 'channelfilter'
     APIKEY = '################'
     PIN = '######################'
     DAY = -1
+    GZIP = False
     URL = 'www.epgdata.com'
+    FETCH_WORKERS = 4
+    RETRIES = 3
+    BACKOFF = 1.0
+    TIMEOUT = 60
+    CHUNK_SIZE = 65536
+    JOBS = 1
+    TVDB_WORKERS = 8
+    TVDB = True
+    DEBUG = False
+    DAEMON = False
+    INTERVAL = 3600
+    SERVE = None
+    PROFILES = None
+    REPORT = None
+    PROMETHEUS = None
     DATEFORMAT = '%Y%m%d'
     timeoffset ="+0000"
 
-    channel_ids = []
-    genre_map = {}
-    category_map = {}
+    def __init__(self, args=(), **settings):
+        # settings override the defaults above by name, e.g.
+        # App(INPUT_PATH='epgdata_files', TVDB=False); args are command line
+        # arguments, see main
+        for name, value in settings.items():
+            if not name.isupper() or not hasattr(App, name):
+                raise TypeError('Unknown setting: {}'.format(name))
+            setattr(self, name, value)
+
+        self.channel_ids = set()
+        self.genre_map = {}
+        self.category_map = {}
+        self.episodes = {}
+        self.failed_episodes = set()
+        self.channel_names = {}
+        self.profiles = []
+        self.context = None
+        self.last_build = None
 
-    def __init__(self):
         parser = OptionParser()
         parser.add_option("-i", "--input", help="The path for the input files.")
         parser.add_option("-o", "--output", help="The path for the output files.")
+        parser.add_option("-c", "--cache", help="The path for the cache files.")
+        parser.add_option("-f", "--channelfilter", help="The channel filter file.")
         parser.add_option("-k", "--key", help="api key for thetvdb.com")
         parser.add_option("-p", "--pin", help="The pin code for epgdata.com")
         parser.add_option("-d", "--day", help="The day to retrieve from epgdata.com")
+        parser.add_option("-u", "--url", help="The host[:port] to fetch the epgdata.com packages from")
+        parser.add_option("-w", "--fetch-workers", dest="fetch_workers", help="Number of parallel downloads")
+        parser.add_option("-j", "--jobs", help="Number of processes converting the day files")
+        parser.add_option("-z", "--gzip", action="store_true", dest="gzip", help="Write a gzip compressed epg.xml.gz")
+        parser.add_option("--no-tvdb", action="store_false", dest="tvdb",
+                          help="Do not look up episode numbers on thetvdb.com")
+        parser.add_option("--daemon", action="store_true", dest="daemon",
+                          help="Keep running and refresh the guide periodically")
+        parser.add_option("--interval", help="Seconds between two refreshes in daemon mode")
+        parser.add_option("--profiles", help="A json file with additional output profiles")
+        parser.add_option("--serve", help="Serve the guide over http on [address:]port")
+        parser.add_option("--report", help="The json file with the timings and counters of the last run")
+        parser.add_option("--prometheus", help="Also write the run report in the Prometheus text format")
         parser.add_option("-v", "--debug", action="store_true", dest="debug", help="Enable debug output")
-        (options, args) = parser.parse_args()
+        (options, args) = parser.parse_args(list(args))
 
         if options.input is not None:
             self.INPUT_PATH = options.input
         if options.output is not None:
             self.OUTPUT_PATH = options.output
+        if options.cache is not None:
+            self.CACHE_PATH = options.cache
+        if options.channelfilter is not None:
+            self.CHANNELFILTER = options.channelfilter
         if options.key is not None:
             self.APIKEY = options.key
         if options.pin is not None:
             self.PIN = options.pin
         if options.day is not None:
             self.DAY = int(options.day)
+        if options.url is not None:
+            self.URL = options.url
+        if options.fetch_workers is not None:
+            self.FETCH_WORKERS = int(options.fetch_workers)
+        if options.jobs is not None:
+            self.JOBS = int(options.jobs)
+        if options.gzip:
+            self.GZIP = True
+        if options.tvdb is False:
+            self.TVDB = False
+        if options.daemon:
+            self.DAEMON = True
+        if options.interval is not None:
+            self.INTERVAL = int(options.interval)
+        if options.serve is not None:
+            self.SERVE = options.serve
+        if options.profiles is not None:
+            self.PROFILES = options.profiles
+        if options.report is not None:
+            self.REPORT = options.report
+        if options.prometheus is not None:
+            self.PROMETHEUS = options.prometheus
         if options.debug:
-            logging.basicConfig(level=logging.DEBUG)
-        else:
-            logging.basicConfig(level=logging.INFO)
+            self.DEBUG = True
+
+        os.makedirs(self.CACHE_PATH, exist_ok=True)
+        if self.REPORT is None:
+            self.REPORT = '{}/{}'.format(self.CACHE_PATH, 'report.json')
+        self.report = RunReport()
+        self.open_tvdb()
+
+        self.evaluate_timeoffset()
+
+        self.manifest = InputManifest(self.INPUT_PATH, self.DATEFORMAT)
+        self.store = ProgrammeStore('{}/{}'.format(self.CACHE_PATH, 'programmes'))
+        self.downloads = DownloadState('{}/{}'.format(self.CACHE_PATH, 'downloads'))
+
+    def run(self):
+        try:
+            server = None
+            if self.SERVE is not None:
+                server = self.start_server()
+            if self.DAEMON:
+                self.run_daemon()
+            else:
+                self.refresh()
+                if server is not None:
+                    server.wait()
+        finally:
+            self.episode_cache.close()
+
+    def start_server(self):
+        address, _, port = self.SERVE.rpartition(':')
+        server = GuideServer(self.output_filename(), address, int(port))
+        server.start()
+        return server
+
+    def run_daemon(self):
+        # Lookup tables, the tvdb client and the caches stay loaded between refreshes
+        log().info('daemon: refreshing every {} seconds.'.format(self.INTERVAL))
+        while True:
+            started = time.time()
+            try:
+                self.refresh()
+            except Exception:
+                log().error("Refresh failed:")
+                log().error(traceback.format_exc())
+            time.sleep(max(0, self.INTERVAL - (time.time() - started)))
 
-        self.t = tvdb_api.Tvdb(apikey=self.APIKEY)
+    def refresh(self):
+        self.report = RunReport()
+        try:
+            with self.report.stage('total'):
+                self.evaluate_timeoffset()
 
-        self.t.config['language'] = 'de'
+                # Clean old files
+                with self.report.stage('cleanup'):
+                    self.cleanup()
 
+                # Fetch include.zip and new files
+                with self.report.stage('fetch'):
+                    self.fetch()
+
+                # Generated Merged File
+                try:
+                    self.generate_merged()
+                finally:
+                    self.report.count('tvdb_cache_hits', self.episode_cache.hits)
+                    self.report.count('tvdb_cache_misses', self.episode_cache.misses)
+                    self.episode_cache.flush()
+            self.report.succeeded = True
+        finally:
+            self.report.write(self.REPORT, self.PROMETHEUS)
+
+    def evaluate_timeoffset(self):
         # evaluate timezone
         localtime = time.localtime()
         if localtime.tm_isdst:
@@ -70,132 +1287,406 @@ class App:
         else:            
             self.timeoffset = time.strftime("+%H%M", time.gmtime(-time.timezone))
 
-        # Clean old files
-        self.cleanup()
+    def __getstate__(self):
+        # Clients and connections are not passed on to conversion workers
+        state = self.__dict__.copy()
+        for name in ['t', 'episode_cache', 'report', 'downloads', 'connections', 'open_connections',
+                     'connections_lock']:
+            state.pop(name, None)
+        return state
 
-        # Fetch include.zip
-        self.fetch_include()
+    def new_tvdb(self):
+        t = tvdb().Tvdb(apikey=self.APIKEY)
 
-        # Fetch new files
-        if self.DAY != -1:
-            self.fetch_data(self.DAY)
-        else:
-            self.DAY = 0
-            while self.DAY <= 6:
-                self.fetch_data(self.DAY)
-                self.DAY += 1
+        t.config['language'] = 'de'
+
+        return t
 
-        # Generated Merged File
-        self.generate_merged()
+    def open_tvdb(self):
+        # The client itself is created on the first lookup, see tvdb_client
+        self.t = None
+        self.episode_cache = EpisodeCache('{}/{}'.format(self.CACHE_PATH, 'tvdb.sqlite'))
+
+    def tvdb_client(self):
+        if self.t is None:
+            self.t = self.new_tvdb()
+        return self.t
 
     def cleanup(self):
         log().debug('cleanup')
 
-        files = os.listdir(self.INPUT_PATH)
-        for filename in files:
-            try:
-                splitted = filename.split('_')
-                file_date = datetime.datetime.strptime(splitted[0], self.DATEFORMAT)
-                date = (datetime.datetime.now() + datetime.timedelta(days=-1))
-                if file_date < date:
-                    os.remove('{}/{}'.format(self.INPUT_PATH, filename))  
+        date = (datetime.datetime.now() + datetime.timedelta(days=-1))
+        for filename, file_date in list(self.manifest.dated_files.items()):
+            if file_date < date:
+                try:
+                    self.manifest.remove(filename)
                     log().info('{} deleted.'.format(filename))
+                except OSError:
+                    log().error('{} failed to delete.'.format(filename))
 
-            except Exception:
+        # Download state of packages of past days
+        for key in self.downloads.keys():
+            key_date = self.manifest.date(key)
+            if key_date is not None and key_date < date:
+                self.downloads.remove(key)
+
+        # Left over from an interrupted extraction
+        for filename in list(self.manifest.partial_files):
+            try:
+                self.manifest.remove(filename)
+            except OSError:
                 log().error('{} failed to delete.'.format(filename))
 
+    def fetch(self):
+        if self.DAY != -1:
+            self.fetch_all([self.DAY])
+        else:
+            self.fetch_all(range(7))
+
+    def fetch_all(self, days):
+        log().debug('fetch_all')
+
+        self.connections = threading.local()
+        self.open_connections = []
+        self.connections_lock = threading.Lock()
+        try:
+            with ThreadPoolExecutor(max_workers=self.FETCH_WORKERS) as executor:
+                futures = [executor.submit(self.fetch_include)]
+                futures += [executor.submit(self.fetch_data, day) for day in days]
+                for future in futures:
+                    future.result()
+        finally:
+            for conn in self.open_connections:
+                conn.close()
+            self.downloads.save()
+            self.manifest.scan()
+
+    def get_connection(self):
+        # One keep-alive connection per download thread
+        conn = getattr(self.connections, 'conn', None)
+        if conn is None:
+            conn = http.client.HTTPConnection(self.URL, timeout=self.TIMEOUT)
+            self.connections.conn = conn
+            with self.connections_lock:
+                self.open_connections.append(conn)
+        return conn
+
+    def fetch_package(self, params, key, conditional=False):
+        # The response is spooled to a file in the download state path. An
+        # interrupted download is resumed with a Range request, in this or a
+        # later run. With conditional the request carries the validators of
+        # the last download and an unchanged package (304 or the same content
+        # hash) is not extracted again.
+        spool_path = self.downloads.spool_path(key)
+        delay = self.BACKOFF
+        with open(spool_path, 'r+b' if os.path.exists(spool_path) else 'w+b') as spool:
+            for attempt in range(self.RETRIES + 1):
+                state = self.downloads.get(key)
+                headers = {'Content-type': 'application/x-www-form-urlencoded', 'Cache-Control': 'no-cache'}
+                offset = spool.seek(0, os.SEEK_END)
+                partial = state.get('partial') or {}
+                validator = partial.get('etag') or partial.get('last_modified')
+                if offset > 0 and validator is not None:
+                    headers['Range'] = 'bytes={}-'.format(offset)
+                    headers['If-Range'] = validator
+                if conditional and 'sha1' in state:
+                    if state.get('etag') is not None:
+                        headers['If-None-Match'] = state['etag']
+                    if state.get('last_modified') is not None:
+                        headers['If-Modified-Since'] = state['last_modified']
+
+                conn = self.get_connection()
+                try:
+                    conn.request('GET', '/index.php?{}'.format(params), None, headers)
+                    response = conn.getresponse()
+                    if 'Range' in headers and response.status not in (200, 206) and response.status < 500:
+                        # The range was refused (416 when the spool already holds
+                        # the whole package): start over without it, right away
+                        response.read()
+                        log().info('{} not resumed ({}), downloading again.'.format(key, response.status))
+                        offset = 0
+                        spool.seek(0)
+                        spool.truncate()
+                        self.downloads.update(key, partial=None)
+                        del headers['Range'], headers['If-Range']
+                        conn.request('GET', '/index.php?{}'.format(params), None, headers)
+                        response = conn.getresponse()
+                    content_length = response.getheader('content-length')
+                    if response.status == 206 and 'Range' in headers and \
+                            (response.getheader('content-range') or '').startswith('bytes {}-'.format(offset)):
+                        self.report.count('fetch_resumed')
+                    elif response.status in (200, 206):
+                        # A new download, the package changed or the range was ignored
+                        offset = 0
+                        spool.seek(0)
+                        spool.truncate()
+                        self.downloads.update(key, partial={'etag': response.getheader('etag'),
+                                                            'last_modified': response.getheader('last-modified')})
+                    if response.status in (200, 206):
+                        shutil.copyfileobj(response, spool, self.CHUNK_SIZE)
+                        spool.flush()
+                    else:
+                        response.read()
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    error = e
+                else:
+                    content_type = response.getheader('content-type')
+                    log().info(params)
+                    log().info(content_type)
+                    log().info(response.status)
+                    if response.status == 304:
+                        log().info('{} not modified.'.format(key))
+                        self.report.count('packages_not_modified')
+                        break
+                    if response.status >= 500:
+                        error = response.status
+                    elif response.status not in (200, 206) or content_type != 'application/x-zip-compressed':
+                        break
+                    elif content_length is not None and spool.tell() != offset + int(content_length):
+                        conn.close()
+                        error = 'truncated, {} of {} bytes'.format(spool.tell(), offset + int(content_length))
+                    else:
+                        size = spool.tell()
+                        sha1 = file_hash(spool_path)
+                        try:
+                            if conditional and sha1 == state.get('sha1'):
+                                log().info('{} unchanged, not extracted.'.format(key))
+                                self.report.count('packages_unchanged')
+                            else:
+                                spool.seek(0)
+                                self.extract_package(spool)
+                            self.report.count('packages_fetched')
+                            self.report.count('bytes_fetched', size - offset)
+                            partial = self.downloads.get(key).get('partial') or {}
+                            self.downloads.update(key, etag=partial.get('etag'),
+                                                  last_modified=partial.get('last_modified'),
+                                                  content_length=size, sha1=sha1, partial=None)
+                            spool.truncate(0)
+                            break
+                        except zipfile.BadZipFile as e:
+                            # Not to be resumed
+                            spool.truncate(0)
+                            self.downloads.update(key, partial=None)
+                            error = e
+
+                if attempt < self.RETRIES:
+                    self.report.count('fetch_retries')
+                    log().warning('{} failed ({}), retrying in {}s.'.format(params, error, delay))
+                    time.sleep(delay)
+                    delay *= 2
+            else:
+                self.report.count('fetch_errors')
+                log().error('{} failed ({}).'.format(params, error))
+                response = None
+
+        # A partial download is kept for the next run
+        if os.path.getsize(spool_path) == 0:
+            os.remove(spool_path)
+        if response is None:
+            return None
+        return response.status
+
+    def extract_package(self, spool):
+        # Uncompress ZIP and save XML. Every member is written to a hidden
+        # .part file first and renamed when complete, so the input path never
+        # holds a truncated file.
+        with zipfile.ZipFile(spool) as xml_zip:
+            for name in xml_zip.namelist():
+                filename = os.path.basename(name)
+                if len(filename) == 0:
+                    continue
+                output_filename = '{}/{}'.format(self.INPUT_PATH, filename)
+                partial_filename = '{}/.{}.part'.format(self.INPUT_PATH, filename)
+                with xml_zip.open(name) as source, open(partial_filename, 'wb') as output:
+                    shutil.copyfileobj(source, output, self.CHUNK_SIZE)
+                os.replace(partial_filename, output_filename)
+
+                # Parse day files once, right away; see ProgrammeStore
+                if filename.endswith('.xml') and self.manifest.date(filename) is not None:
+                    try:
+                        self.store.build(output_filename)
+                    except (cElementTree.ParseError, sqlite3.Error) as e:
+                        log().warning('{} not stored ({}).'.format(filename, e))
+
     def fetch_include(self):
-        # Fetch include
+        # Fetch include, conditionally while all tables are there
         params = urllib.parse.urlencode(
             {'action': 'sendInclude', 'iOEM': 'vdr', 'pin': self.PIN, 'dataType': 'xml'})
-        headers = {'Content-type': 'application/x-www-form-urlencoded', 'Cache-Control': 'no-cache'}
-        conn = http.client.HTTPConnection("www.epgdata.com")
-        conn.request('GET', '/index.php?{}'.format(params), None, headers)
-        response = conn.getresponse()
-        content_type = response.getheader('content-type')
-        log().info(params)
-        log().info(content_type)
-        log().info(response.status)
-
-        if response.status == 200 and content_type == 'application/x-zip-compressed':
-            # Content
-            content = response.read()
-
-            # Uncompress ZIP and save XML
-            xml_zip = zipfile.ZipFile(BytesIO(content))
-            for name in xml_zip.namelist():
-                uncompressed = xml_zip.read(name)
-                output_filename = '{}/{}'.format(self.INPUT_PATH, name)
-                output = open(output_filename, 'wb')
-                output.write(uncompressed)
-                output.close()        
+        conditional = all(os.path.exists(self.manifest.include(role)) for role in InputManifest.INCLUDES)
+        self.fetch_package(params, 'include', conditional)
 
     def fetch_data(self, day):
         # Exists
         date = (datetime.datetime.now() + datetime.timedelta(days=day))
-        files = os.listdir(self.INPUT_PATH)
-        for filename in files:
-            if filename.startswith(date.strftime(self.DATEFORMAT)):
-                log().info('Already fetched.')
-                return
+        if self.manifest.fetched(date):
+            log().info('Already fetched.')
+            return
 
         # Fetch data
         params = urllib.parse.urlencode(
-            {'action': 'sendPackage', 'iOEM': 'vdr', 'dayOffset': self.DAY, 'pin': self.PIN, 'dataType': 'xml'})
-        headers = {'Content-type': 'application/x-www-form-urlencoded', 'Cache-Control': 'no-cache'}
-        conn = http.client.HTTPConnection("www.epgdata.com")
-        conn.request('GET', '/index.php?{}'.format(params), None, headers)
-        response = conn.getresponse()
-        content_type = response.getheader('content-type')
-        log().info(params)
-        log().info(content_type)
-        log().info(response.status)
-
-        if response.status == 200 and content_type == 'application/x-zip-compressed':
-            # Content
-            content = response.read()
-
-            # Uncompress ZIP and save XML
-            xml_zip = zipfile.ZipFile(BytesIO(content))
-            for name in xml_zip.namelist():
-                uncompressed = xml_zip.read(name)
-                output_filename = '{}/{}'.format(self.INPUT_PATH, name)
-                output = open(output_filename, 'wb')
-                output.write(uncompressed)
-                output.close()
+            {'action': 'sendPackage', 'iOEM': 'vdr', 'dayOffset': day, 'pin': self.PIN, 'dataType': 'xml'})
+        self.fetch_package(params, date.strftime(self.DATEFORMAT))
 
     def generate_merged(self):
         log().debug('generate_merged')
-        
-        # New xml
-        impl = getDOMImplementation()
-        new_doc = impl.createDocument(None, "tv", None)
-        top_element = new_doc.documentElement
-        top_element.setAttribute("generator-info-name", 'EPGData2XMLTV')
-        top_element.setAttribute("generator-info-url", 'http://github.com/ortegaangelo/EPGData2XMLTV')
-                
-        # Categories '{}/{}'.format(self.INPUT_PATH, 'category.xml')
-        self.parse_categories('{}/{}'.format(self.INPUT_PATH, 'category.xml'))
 
-        # Genres
-        self.parse_genres('{}/{}'.format(self.INPUT_PATH, 'genre.xml'))    
+        with self.report.stage('includes'):
+            self.load_includes()
+        files, cache, pending = self.convert()
+        self.write(files, cache, pending)
+
+    def convert(self):
+        # Converts the day files that are not cached yet. Returns the day
+        # files, the conversion cache holding their fragments and the day
+        # files converted.
+        files = self.manifest.days()
+        cache = ConversionCache('{}/{}'.format(self.CACHE_PATH, 'fragments'), self.context, self.variants())
+        counts = {}
+        for xml_file in files:
+            counts[xml_file] = cache.lookup(xml_file)
+        pending = [xml_file for xml_file in files if counts[xml_file] is None]
+        self.report.count('files_cached', len(files) - len(pending))
+        with self.report.stage('enrich'):
+            self.enrich_episodes(pending)
+        with self.report.stage('convert'):
+            for xml_file, count in zip(pending, self.convert_files(pending, cache)):
+                cache.store(xml_file, count)
+                counts[xml_file] = count
+        cache.close(files)
+        self.store.prune(files)
+        return files, cache, pending
+
+    def write(self, files, cache, pending):
+        # New xml, the full guide and one per profile
+        outputs = [(self.output_filename(), self.GZIP, (), None, None)]
+        for profile in self.profiles:
+            channel_ids = None
+            if profile.channel_filter is not None:
+                channel_ids = set(channel_id for channel_id, name in self.channel_names.items()
+                                  if profile.channel_filter.matches(channel_id, name))
+            outputs.append((profile.filename(self.OUTPUT_PATH), profile.gzip, profile.exclude,
+                            channel_ids, profile.window()))
+
+        build = (self.context, [output[0] for output in outputs], files)
+        if len(pending) == 0 and build == self.last_build \
+                and all(output[4] is None and os.path.exists(output[0]) for output in outputs):
+            log().info('{} is up to date.'.format(outputs[0][0]))
+            return
+
+        for output_filename, compress, variant, channel_ids, window in outputs:
+            stats = {'duplicates': 0, 'overlaps': 0}
+            with self.report.stage('write'):
+                writer = XMLTVWriter(output_filename, compress)
+                try:
+                    writer.open([("generator-info-name", 'EPGData2XMLTV'),
+                                 ("generator-info-url", 'http://github.com/ortegaangelo/EPGData2XMLTV')])
+                    writer.write_fragment(self.channels_path(), self.channel_count, channel_ids)
+                    fragment_paths = [cache.fragment_path(xml_file, variant) for xml_file in files]
+                    writer.write_programmes(merge_programmes(fragment_paths, stats, channel_ids), window)
+                except:
+                    writer.discard()
+                    raise
+                writer.close()
+
+            if output_filename == outputs[0][0]:
+                self.report.count('programmes_duplicate', stats['duplicates'])
+                self.report.count('programmes_overlapping', stats['overlaps'])
+                log().info('{} duplicate and {} overlapping programmes dropped or cut.'.format(
+                    stats['duplicates'], stats['overlaps']))
+            self.report.count('elements_written', writer.count)
+            self.report.count('bytes_written', os.path.getsize(output_filename))
+            log().info('{} elements written to {}.'.format(writer.count, output_filename))
+        self.last_build = build
+
+    def variants(self):
+        # The fragment variants needed by the full guide and the profiles
+        return tuple(sorted(set([()] + [profile.exclude for profile in self.profiles])))
+
+    def output_filename(self):
+        if self.GZIP:
+            return self.OUTPUT_PATH + "/epg.xml.gz"
+        return self.OUTPUT_PATH + "/epg.xml"
+
+    def load_includes(self):
+        # Parses the include tables and renders the channels, unless neither
+        # they nor the channel filter changed since the last call
+        context = self.conversion_context()
+        if context == self.context and os.path.exists(self.channels_path()):
+            return
+
+        # Categories
+        self.category_map = {}
+        self.parse_categories(self.manifest.include('category'))
 
-        # Channels
-        self.generate_channel_data(top_element, '{}/{}'.format(self.INPUT_PATH, 'channel_y.xml'))
+        # Genres
+        self.genre_map = {}
+        self.parse_genres(self.manifest.include('genre'))
 
-        # Program data
-        files = glob.glob(self.INPUT_PATH + "/*.xml")
-        for xml_file in files:
-            top_element = self.generate_program_data(top_element, xml_file)
+        # Output profiles
+        if self.PROFILES is not None:
+            self.profiles = OutputProfile.load(self.PROFILES)
 
-        # Write to file
-        xml = ['<?xml version="1.0" encoding="utf-8" standalone="yes"?>', top_element.toprettyxml()]
-        file_handle = open(self.OUTPUT_PATH + "/epg.xml", "w")
-        file_handle.write(''.join(xml))
-        file_handle.close()
+        # Channels
+        self.channel_filter = ChannelFilter.load(self.CHANNELFILTER)
+        self.channel_ids = set()
+        self.channel_names = {}
+        fragment = FragmentWriter(self.channels_path())
+        try:
+            self.generate_channel_data(fragment, self.manifest.include('channel'))
+        except:
+            fragment.discard()
+            raise
+        fragment.close()
+        self.channel_count = fragment.count
+        self.context = context
+
+    def channels_path(self):
+        return '{}/{}'.format(self.CACHE_PATH, 'channels.frag')
+
+    def convert_files(self, files, cache):
+        # Returns the element count of each converted file, in order
+        fragment_paths = [cache.fragment_paths(xml_file) for xml_file in files]
+        if self.JOBS <= 1 or len(files) <= 1:
+            return [self.convert_file(xml_file, fragment_path)
+                    for xml_file, fragment_path in zip(files, fragment_paths)]
+
+        counts = []
+        with ProcessPoolExecutor(max_workers=min(self.JOBS, len(files)),
+                                 initializer=convert_worker_init, initargs=(self,)) as executor:
+            for count, hits, misses, report in executor.map(convert_worker, files, fragment_paths):
+                counts.append(count)
+                self.episode_cache.hits += hits
+                self.episode_cache.misses += misses
+                self.report.merge(report)
+        return counts
+
+    def convert_file(self, xml_file, fragment_paths):
+        started = time.perf_counter()
+        fragment = FragmentSet(fragment_paths)
+        try:
+            self.generate_program_data(fragment, xml_file)
+        except:
+            fragment.discard()
+            raise
+        fragment.close()
+        self.report.count('files_converted')
+        self.report.file(xml_file, seconds=time.perf_counter() - started, elements=fragment.count)
+        return fragment.count
+
+    def conversion_context(self):
+        # Everything besides the day file itself that the rendered programmes depend on
+        digest = hashlib.sha1(self.timeoffset.encode())
+        digest.update(b'tvdb' if self.TVDB else b'no-tvdb')
+        for role in ['category', 'genre', 'channel']:
+            digest.update(file_hash(self.manifest.include(role)).encode())
+        digest.update(file_hash(self.CHANNELFILTER).encode())
+        if self.PROFILES is not None:
+            digest.update(file_hash(self.PROFILES).encode())
+        return digest.hexdigest()
 
     def parse_categories(self, epg_path):
-        log().debug('parse_categories: ' +epg_path)
+        log().debug('parse_categories: %s', epg_path)
 
         context = cElementTree.iterparse(epg_path, events=("start", "end",))
         context = iter(context)
@@ -208,7 +1699,7 @@ class App:
                 root.clear()
             
     def parse_genres(self, epg_path):
-        log().debug('parse_genres: ' +epg_path)
+        log().debug('parse_genres: %s', epg_path)
         
         context = cElementTree.iterparse(epg_path, events=("start", "end",))
         context = iter(context)
@@ -221,7 +1712,7 @@ class App:
                 root.clear()
 
     def generate_channel_data(self, parent, channel_path):
-        log().debug('generate_channel_data: ' +channel_path)
+        log().debug('generate_channel_data: %s', channel_path)
 
         context = cElementTree.iterparse(channel_path, events=("start", "end",))
         context = iter(context)
@@ -230,22 +1721,17 @@ class App:
             if event == "end" and elem.tag == 'data':                    
                 child = self.generate_channel_element(elem)
                 if child is not None:
-                    parent.appendChild(child)
+                    parent.write(child)
                 root.clear()
 
     def generate_channel_element(self, elem):
-
-        # Read channel filter
-        with open("channelfilter") as f:
-            channel_filter = f.read().splitlines()
-
         tvchannel_id = elem.findtext('ch4')
         tvchannel_name = elem.findtext('ch0')
 
-        if tvchannel_name not in channel_filter:
+        if not self.channel_filter.matches(tvchannel_id, tvchannel_name):
             return None
 
-        log().debug('generate_channel_element: ' +tvchannel_name)
+        log().debug('generate_channel_element: %s', tvchannel_name)
 
         impl = getDOMImplementation()
         new_doc = impl.createDocument(None, "channel", None)
@@ -259,61 +1745,66 @@ class App:
             display_name_node.appendChild(display_name)
             top_element.appendChild(display_name_node)
 
-        self.channel_ids.append(tvchannel_id)
+        self.channel_ids.add(tvchannel_id)
+        self.channel_names[tvchannel_id] = tvchannel_name
 
         return top_element
 
     def generate_program_data(self, parent, epg_path):
-        log().debug('generate_program_data: ' +epg_path)
-
-        context = cElementTree.iterparse(epg_path, events=("start", "end",))
-        context = iter(context)
-        event, root = next(context)
-        for event, elem in context:
-            if event == "end" and elem.tag == 'data':                    
-                child = self.generate_program_element(elem)
-                if child is not None:
-                    parent.appendChild(child)
-                root.clear()
-
+        log().debug('generate_program_data: %s', epg_path)
+
+        # Sorted by channel and start for merge_programmes
+        rows, records = self.store.records(epg_path, self.channel_ids)
+        records.sort(key=lambda record: (record.tvchannel_id, record.starttime, record.endtime,
+                                         record.broadcast_id or ''))
+        filtered = rows - len(records)
+        for record in records:
+            child = self.generate_program_element(record)
+            if child is not None:
+                parent.write(child, (record.tvchannel_id, xmltv_time(record.starttime, self.timeoffset),
+                                     xmltv_time(record.endtime, self.timeoffset), record.broadcast_id or ''))
+
+        self.report.count('rows_in', rows)
+        self.report.count('rows_filtered', filtered)
+        self.report.count('rows_out', parent.count)
+        self.report.file(epg_path, rows_in=rows, rows_filtered=filtered)
+        log().debug('generate_program_data: %d rows, %d filtered by channel', rows, filtered)
         return parent
 
-    def generate_program_element(self, elem):
-        tvchannel_id = elem.findtext('d2')
+    def generate_program_element(self, record):
+        tvchannel_id = record.tvchannel_id
         if tvchannel_id not in self.channel_ids:
             return None
 
-        #broadcast_id = elem.findtext('d0')
-        starttime = elem.findtext('d4')
-        endtime = elem.findtext('d5')
-        tvshow_length = elem.findtext('d7')
-        primetime = elem.findtext('d9')
-        category_id = elem.findtext('d10')
-        age_marker = elem.findtext('d16')
-        title = elem.findtext('d19')
-        subtitle = elem.findtext('d20')
-        comment_long = elem.findtext('d21')
-        genreid = elem.findtext('d25')
-        sequence = elem.findtext('d26')
-        tvd_total_value = elem.findtext('d30')
-        country = elem.findtext('d32')
-        year = elem.findtext('d33')
-        moderator = elem.findtext('d34')
-        studio_guest = elem.findtext('d35')
-        regisseur = elem.findtext('d36')
-        actor = elem.findtext('d37')
-        image_big = elem.findtext('d40')
-
-        log().debug('generate_program_element: ' +title)
+        #broadcast_id = record.broadcast_id
+        starttime = record.starttime
+        endtime = record.endtime
+        tvshow_length = record.tvshow_length
+        primetime = record.primetime
+        category_id = record.category_id
+        age_marker = record.age_marker
+        title = record.title
+        subtitle = record.subtitle
+        comment_long = record.comment_long
+        genreid = record.genreid
+        sequence = record.sequence
+        tvd_total_value = record.tvd_total_value
+        country = record.country
+        year = record.year
+        moderator = record.moderator
+        studio_guest = record.studio_guest
+        regisseur = record.regisseur
+        actor = record.actor
+        image_big = record.image_big
+
+        log().debug('generate_program_element: %s', title)
 
         impl = getDOMImplementation()
         new_doc = impl.createDocument(None, "programme", None)
         top_element = new_doc.documentElement
         top_element.setAttribute("channel", tvchannel_id)
-        top_element.setAttribute("start", datetime.datetime.strptime(starttime, '%Y-%m-%d %H:%M:%S')
-                                 .strftime('%Y%m%d%H%M%S '+self.timeoffset))
-        top_element.setAttribute("stop", datetime.datetime.strptime(endtime, '%Y-%m-%d %H:%M:%S')
-                                 .strftime('%Y%m%d%H%M%S '+self.timeoffset))
+        top_element.setAttribute("start", xmltv_time(starttime, self.timeoffset))
+        top_element.setAttribute("stop", xmltv_time(endtime, self.timeoffset))
 
         if len(title)>0:
             title_node = new_doc.createElement("title")
@@ -336,58 +1827,24 @@ class App:
             desc_node.appendChild(desc_text)
             top_element.appendChild(desc_node)
 
-        director_list = []
-        if len(regisseur)>0:
-            parts = regisseur.split('|')
-            for name in parts:
-                director_list.append(name)
-        
-        actor_list = []
-        if len(actor)>0:
-            parts = actor.split(') - ')
-            for name in parts:
-                actor_list.append(name+")")
-
-        presenter_list = []
-        if len(moderator)>0:
-            parts = moderator.split('|')
-            for name in parts:
-                presenter_list.append(name)
-
-        guest_list = []
-        if len(studio_guest)>0:
-            parts = studio_guest.split('|')
-            for name in parts:
-                guest_list.append(name)
-
-        if len(director_list)>0 or len(actor_list)>0 or len(presenter_list)>0 or len(guest_list)>0:
+        if len(regisseur)>0 or len(actor)>0 or len(moderator)>0 or len(studio_guest)>0:
             credits_node = new_doc.createElement("credits")
-            for name in director_list:
+            for name in parse_names(regisseur):
                 director_node = new_doc.createElement("director")
                 director_text = new_doc.createTextNode(name)
                 director_node.appendChild(director_text)
                 credits_node.appendChild(director_node)
-            for name in actor_list:                
-                actor_node = new_doc.createElement("actor")                
-                actor_name = re.findall(r"(.*?)\(.*?\)", name)
-                #actor_role = re.findall(r"(?<=\().*?(?=\))", name)
-                if len(actor_name)>0:
-                    if len(actor_name[0].strip())>0:
-                        actor_text = new_doc.createTextNode(actor_name[0].strip())
-                        actor_node.appendChild(actor_text)
-                else:            
-                    actor_text = new_doc.createTextNode(name)
-                    actor_node.appendChild(actor_text)
-                #if actor_role and len(actor_role[0])>0:
-                #    actor_node.setAttribute("role", actor_role[0])
-                if actor_node.hasChildNodes():
-                    credits_node.appendChild(actor_node)
-            for name in presenter_list:
+            for name in parse_actors(actor):
+                actor_node = new_doc.createElement("actor")
+                actor_text = new_doc.createTextNode(name)
+                actor_node.appendChild(actor_text)
+                credits_node.appendChild(actor_node)
+            for name in parse_names(moderator):
                 presenter_node = new_doc.createElement("presenter")
                 presenter_text = new_doc.createTextNode(name)
                 presenter_node.appendChild(presenter_text)
                 credits_node.appendChild(presenter_node)
-            for name in guest_list:                
+            for name in parse_names(studio_guest):
                 guest_node = new_doc.createElement("guest")
                 guest_text = new_doc.createTextNode(name)
                 guest_node.appendChild(guest_text)
@@ -435,31 +1892,19 @@ class App:
             season = ""
             episodeNumber = str(int(sequence)-1)
             if len(subtitle)>0:
-                try:
-                    seriesName = title.split(' - ')
-                    episodeName = subtitle.split(' / ')
-                    episode_tvdb = self.t[seriesName[0]].search(episodeName[0], key='episodeName')
-                    if len(episode_tvdb)>0:
-                        season = str(episode_tvdb[0]['airedSeason']-1)
-                        episodeNumber = str(episode_tvdb[0]['airedEpisodeNumber']-1)
-                        log().debug('episode: ' +title + '.' + subtitle + '.' + season + '.' + episodeNumber)
-                except tvdb_api.tvdb_shownotfound:
-                    log().info("Could not find episode for: " + title + '.' + subtitle)
-                except tvdb_api.tvdb_error:
-                    log().error("tvdb error: " + title + '.' + subtitle)
-                except KeyError:
-                    log().error("Mapping key not found: " + title + '.' + subtitle)
-                except:
-                    log().error("Unexpected error:")
-                    log().error(traceback.format_exc())
+                seriesName, episodeName = episode_key(title, subtitle)
+                episode_tvdb = self.lookup_episode(seriesName, episodeName)
+                if episode_tvdb is not None:
+                    season = str(episode_tvdb[0]-1)
+                    episodeNumber = str(episode_tvdb[1]-1)
+                    log().debug('episode: %s.%s.%s.%s', title, subtitle, season, episodeNumber)
 
             episode_text = new_doc.createTextNode(season+"."+episodeNumber+".")
             episode_node.appendChild(episode_text)
             top_element.appendChild(episode_node)
             
         if len(country)>0:
-            parts = country.split('|')
-            for c in parts:
+            for c in parse_names(country):
                 country_node = new_doc.createElement("country")
                 country_text = new_doc.createTextNode(c)
                 country_node.appendChild(country_text)
@@ -501,4 +1946,154 @@ class App:
 
         return top_element
 
-App()
+    def collect_episodes(self, files):
+        # The distinct (series, episode) pairs generate_program_element looks
+        # up. Read from the programme stores; with -j the stores of day files
+        # that were not parsed yet are built in parallel processes.
+        collect = functools.partial(self.store.episodes, channel_ids=self.channel_ids)
+        if self.JOBS <= 1 or len(files) <= 1:
+            results = map(collect, files)
+        else:
+            with ProcessPoolExecutor(max_workers=min(self.JOBS, len(files))) as executor:
+                results = list(executor.map(collect, files))
+        episodes = set()
+        for pairs in results:
+            for title, subtitle in pairs:
+                episodes.add(episode_key(title, subtitle))
+        return episodes
+
+    def enrich_episodes(self, files):
+        # Resolves all episodes of files before the conversion, concurrently
+        # and with one task per series. The results end up in self.episodes
+        # and the episode cache, see lookup_episode. Pairs whose lookup failed
+        # go to self.failed_episodes and are not queried again in this run.
+        log().debug('enrich_episodes')
+
+        self.episodes = {}
+        self.failed_episodes = set()
+        if not self.TVDB:
+            return
+        try:
+            self.resolve_episodes(files)
+        finally:
+            # Conversion workers write to the same cache file
+            self.episode_cache.commit()
+
+    def resolve_episodes(self, files):
+        pending = {}
+        for series_name, episode_name in self.collect_episodes(files):
+            cached = self.episode_cache.get(series_name, episode_name)
+            if cached is not None:
+                self.episodes[(series_name, episode_name)] = cached
+            else:
+                pending.setdefault(series_name, set()).add(episode_name)
+        if len(pending) == 0:
+            return
+
+        clients = threading.local()
+        with ThreadPoolExecutor(max_workers=self.TVDB_WORKERS) as executor:
+            futures = [executor.submit(self.resolve_series, clients, series_name, sorted(episode_names))
+                       for series_name, episode_names in sorted(pending.items())]
+            for future in futures:
+                series_name, results = future.result()
+                for episode_name, result in results:
+                    if result is not None:
+                        self.episode_cache.put(series_name, episode_name, result[0], result[1])
+                        self.episodes[(series_name, episode_name)] = result
+                    else:
+                        self.failed_episodes.add((series_name, episode_name))
+
+        log().info('tvdb: {} episodes of {} series resolved.'.format(
+            sum(len(episode_names) for episode_names in pending.values()), len(pending)))
+
+    def resolve_series(self, clients, series_name, episode_names):
+        # Runs in the enrich_episodes pool, one tvdb client per thread
+        client = getattr(clients, 't', None)
+        if client is None:
+            client = clients.t = self.new_tvdb()
+
+        results = []
+        for episode_name in episode_names:
+            try:
+                results.append((episode_name, self.query_episode(client, series_name, episode_name)))
+            except tvdb().tvdb_shownotfound:
+                log().info("Could not find series: " + series_name)
+                results = [(episode_name, (None, None)) for episode_name in episode_names]
+                break
+        return series_name, results
+
+    def lookup_episode(self, series_name, episode_name):
+        if not self.TVDB or (series_name, episode_name) in self.failed_episodes:
+            return None
+        result = self.episodes.get((series_name, episode_name))
+        if result is None:
+            result = self.episode_cache.get(series_name, episode_name)
+        if result is None:
+            try:
+                result = self.query_episode(self.tvdb_client(), series_name, episode_name)
+            except tvdb().tvdb_shownotfound:
+                log().info("Could not find episode for: " + series_name + '.' + episode_name)
+                result = (None, None)
+            if result is None:
+                return None
+            self.episode_cache.put(series_name, episode_name, result[0], result[1])
+
+        if result[0] is None:
+            return None
+        return result
+
+    def query_episode(self, client, series_name, episode_name):
+        # Returns (season, number), (None, None) if the episode is unknown and
+        # None on an error. tvdb_shownotfound is left to the caller.
+        self.report.count('tvdb_queries')
+        try:
+            episode_tvdb = client[series_name].search(episode_name, key='episodeName')
+            if len(episode_tvdb)>0:
+                return episode_tvdb[0]['airedSeason'], episode_tvdb[0]['airedEpisodeNumber']
+            return None, None
+        except tvdb().tvdb_shownotfound:
+            raise
+        except tvdb().tvdb_error:
+            self.report.count('tvdb_errors')
+            log().error("tvdb error: " + series_name + '.' + episode_name)
+        except KeyError:
+            self.report.count('tvdb_errors')
+            log().error("Mapping key not found: " + series_name + '.' + episode_name)
+        except:
+            self.report.count('tvdb_errors')
+            log().error("Unexpected error:")
+            log().error(traceback.format_exc())
+
+        return None
+
+
+# Conversion worker processes, see App.convert_files
+worker_app = None
+
+
+def convert_worker_init(app):
+    global worker_app
+    app.open_tvdb()
+    app.episode_cache.COMMIT_INTERVAL = 1
+    worker_app = app
+
+
+def convert_worker(xml_file, fragment_paths):
+    worker_app.report = RunReport()
+    count = worker_app.convert_file(xml_file, fragment_paths)
+    cache = worker_app.episode_cache
+    cache.commit()
+    hits, misses = cache.hits, cache.misses
+    cache.hits = cache.misses = 0
+    return count, hits, misses, worker_app.report.state()
+
+
+def main(args=None):
+    # Command line entry point
+    app = App(sys.argv[1:] if args is None else args)
+    logging.basicConfig(level=logging.DEBUG if app.DEBUG else logging.INFO)
+    app.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+import datetime
+import functools
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+from optparse import OptionParser
+
+import app
+
+TITLES = ['Tatort', 'Sturm der Liebe', 'Rote Rosen', 'Tagesschau', 'Der Bergdoktor', 'Die Simpsons - Folge']
+SUBTITLES = ['', '', 'Die Rückkehr / Teil 1', 'Abschied', 'Neubeginn']
+ACTORS = ['', 'Hans Muster (Kommissar) - Erika Muster (Ärztin)', 'Max Mustermann (Max)']
+
+
+class StubShow:
+
+    def __init__(self, name):
+        self.name = name
+
+    def search(self, episode_name, key=None):
+        return [{'airedSeason': len(self.name) % 9 + 1, 'airedEpisodeNumber': len(episode_name) % 30 + 1}]
+
+
+class StubTvdb:
+    # Stands in for tvdb_api.Tvdb, answers every lookup without a request
+
+    def __init__(self, apikey=None, **kwargs):
+        self.config = {}
+
+    def __getitem__(self, series_name):
+        return StubShow(series_name)
+
+
+class BenchmarkApp(app.App):
+
+    def new_tvdb(self):
+        return StubTvdb()
+
+
+def generate_includes(path, channels, genres=30, categories=10):
+    with open(os.path.join(path, 'channel_y.xml'), 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<channel>\n')
+        for channel_id, name in channels:
+            f.write('<data><ch0>{}</ch0><ch1>{}</ch1><ch4>{}</ch4></data>\n'.format(name, name, channel_id))
+        f.write('</channel>\n')
+    with open(os.path.join(path, 'genre.xml'), 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<genre>\n')
+        for genre in range(1, genres):
+            f.write('<data><g0>{0}</g0><g1>Genre {0}</g1></data>\n'.format(genre))
+        f.write('</genre>\n')
+    with open(os.path.join(path, 'category.xml'), 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<category>\n')
+        for category in range(1, categories):
+            f.write('<data><ca0>{0}</ca0><ca1>Kategorie {0}</ca1></data>\n'.format(category))
+        f.write('</category>\n')
+
+
+def generate_day_file(path, date, rows, channels, seed=0):
+    # A day file in the epgdata.com layout with all fields the converter reads
+    rnd = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<pack>\n')
+        for row in range(rows):
+            start = date + datetime.timedelta(minutes=5 * rnd.randrange(288))
+            length = rnd.choice([15, 30, 45, 60, 90])
+            fields = [
+                ('d0', row + 1), ('d1', 1), ('d2', channels[row % len(channels)]), ('d3', 1),
+                ('d4', start.strftime('%Y-%m-%d %H:%M:%S')),
+                ('d5', (start + datetime.timedelta(minutes=length)).strftime('%Y-%m-%d %H:%M:%S')),
+                ('d7', length), ('d9', rnd.choice([0, 1])), ('d10', rnd.randrange(1, 10)),
+                ('d16', rnd.choice(['', '6', '12', '16'])), ('d19', rnd.choice(TITLES)),
+                ('d20', rnd.choice(SUBTITLES)), ('d21', 'Beschreibung der Sendung ' * rnd.randrange(4)),
+                ('d25', rnd.randrange(1, 30)), ('d26', rnd.choice([0, 0, 12, 345])), ('d30', rnd.randrange(5)),
+                ('d32', rnd.choice(['', 'D', 'D|USA'])), ('d33', rnd.choice(['', '2019'])),
+                ('d34', rnd.choice(['', 'Anne Will'])), ('d35', rnd.choice(['', 'Gast A|Gast B'])),
+                ('d36', rnd.choice(['', 'Regie Eins|Regie Zwei'])), ('d37', rnd.choice(ACTORS)),
+                ('d40', rnd.choice(['', 'http://www.epgdata.com/images/1.jpg'])),
+            ]
+            f.write('<data>{}</data>\n'.format(''.join('<{0}>{1}</{0}>'.format(tag, value) for tag, value in fields)))
+        f.write('</pack>\n')
+
+
+def generate_fixtures(path, channels, days, rows):
+    # rows per channel and day; every second channel is in the channel filter
+    channel_list = [(str(100 + i), 'Kanal {}'.format(i)) for i in range(channels)]
+    channel_ids = [channel_id for channel_id, name in channel_list]
+    os.makedirs(os.path.join(path, 'input'))
+    generate_includes(os.path.join(path, 'input'), channel_list)
+    today = datetime.datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    for day in range(days):
+        date = today + datetime.timedelta(days=day)
+        filename = '{0}_{0}_de_qy.xml'.format(date.strftime('%Y%m%d'))
+        generate_day_file(os.path.join(path, 'input', filename), date, rows * channels, channel_ids, seed=day)
+    with open(os.path.join(path, 'channelfilter'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(name for channel_id, name in channel_list[::2]) + '\n')
+    return channels * days * rows
+
+
+STAGES = [
+    (app.App, 'parse_categories', 'include'),
+    (app.App, 'parse_genres', 'include'),
+    (app.App, 'generate_channel_data', 'channels'),
+    (app.ProgrammeStore, 'build', 'store'),
+    (app.App, 'convert_files', 'convert'),
+    (app.XMLTVWriter, 'write_fragment', 'write'),
+    (app.XMLTVWriter, 'write_programmes', 'write'),
+]
+
+
+def timed(method, timings, stage):
+    # Adds the wall time of method to timings[stage]
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+    return wrapper
+
+
+def bench_pipeline(path, jobs):
+    # One cold run (nothing cached) and one warm run (all day files parsed
+    # and converted)
+    os.makedirs(os.path.join(path, 'output'), exist_ok=True)
+    application = BenchmarkApp(['-i', os.path.join(path, 'input'), '-o', os.path.join(path, 'output'),
+                           '-c', os.path.join(path, 'cache'), '-f', os.path.join(path, 'channelfilter'),
+                           '-j', str(jobs)])
+    results = {}
+    for run in ['cold', 'warm']:
+        # Like a new process: the includes are parsed and the guide is written again
+        application.context = None
+        application.last_build = None
+        timings = {}
+        for cls, name, stage in STAGES:
+            setattr(cls, name, timed(getattr(cls, name), timings, stage))
+        started = time.perf_counter()
+        try:
+            application.generate_merged()
+        finally:
+            for cls, name, stage in STAGES:
+                setattr(cls, name, getattr(cls, name).__wrapped__)
+        timings['total'] = time.perf_counter() - started
+        results[run] = timings
+    application.episode_cache.close()
+    results['output_bytes'] = os.path.getsize(os.path.join(path, 'output', 'epg.xml'))
+    return results
+
+
+def extract_findtext(elem, channel_ids, timeoffset):
+    # The extraction as done before ProgrammeRecord: one findtext per field
+    if elem.findtext('d2') not in channel_ids:
+        return None
+    values = [elem.findtext(tag) for tag in app.ProgrammeRecord.FIELDS]
+    datetime.datetime.strptime(elem.findtext('d4'), '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d%H%M%S ' + timeoffset)
+    datetime.datetime.strptime(elem.findtext('d5'), '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d%H%M%S ' + timeoffset)
+    return values
+
+
+def extract_record(elem, channel_ids, timeoffset):
+    record = app.ProgrammeRecord.from_element(elem, channel_ids)
+    if record is None:
+        return None
+    app.xmltv_time(record.starttime, timeoffset)
+    app.xmltv_time(record.endtime, timeoffset)
+    return record
+
+
+def bench_extraction(path, channel_ids, extract):
+    # Seconds spent in extract, parsing excluded
+    elapsed = 0.0
+    rows = 0
+    for elem in app.iter_rows(path):
+        started = time.perf_counter()
+        extract(elem, channel_ids, '+0100')
+        elapsed += time.perf_counter() - started
+        rows += 1
+    return elapsed, rows
+
+
+def peak_rss():
+    # In kilobytes, conversion workers included
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_result(filename, result):
+    # The file holds a list of results, one per benchmark run
+    try:
+        with open(filename) as f:
+            results = json.load(f)
+    except (OSError, ValueError):
+        results = []
+    results.append(result)
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-c", "--channels", type="int", default=100, help="Channels in the synthetic guide")
+    parser.add_option("-d", "--days", type="int", default=7, help="Day files in the synthetic guide")
+    parser.add_option("-r", "--rows", type="int", default=30, help="Rows per channel and day")
+    parser.add_option("-j", "--jobs", type="int", default=1, help="Number of conversion processes")
+    parser.add_option("-o", "--output", default="benchmark.json", help="The json file the results are added to")
+    parser.add_option("-x", "--extraction", action="store_true",
+                      help="Only compare the row extraction (findtext vs. ProgrammeRecord) on one day file")
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if options.extraction:
+            path = os.path.join(tmp, 'day.xml')
+            channels = [str(100 + i) for i in range(options.channels)]
+            generate_day_file(path, datetime.datetime(2020, 1, 1), options.rows * options.channels, channels)
+            # Convert about half of the channels
+            channel_ids = set(channels[::2])
+
+            for name, extract in [('findtext', extract_findtext), ('record', extract_record)]:
+                elapsed, rows = bench_extraction(path, channel_ids, extract)
+                print('{:10} {:8} rows {:8.3f} s {:8.2f} us/row'.format(name, rows, elapsed, elapsed / rows * 1e6))
+            return
+
+        rows = generate_fixtures(tmp, options.channels, options.days, options.rows)
+        stages = bench_pipeline(tmp, options.jobs)
+
+    result = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': revision(),
+        'python': platform.python_version(),
+        'channels': options.channels,
+        'days': options.days,
+        'rows': rows,
+        'jobs': options.jobs,
+        'rows_per_second': rows / stages['cold']['total'],
+        'peak_rss_kb': peak_rss(),
+        'stages': stages,
+    }
+    save_result(options.output, result)
+
+    print('{} rows, {:.0f} rows/s, peak rss {} KB'.format(rows, result['rows_per_second'], result['peak_rss_kb']))
+    for run in ['cold', 'warm']:
+        print('{:5} {}'.format(run, ', '.join('{} {:.3f} s'.format(stage, seconds)
+                                              for stage, seconds in sorted(stages[run].items()))))
+
+
+if __name__ == '__main__':
+    main()
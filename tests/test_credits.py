@@ -0,0 +1,140 @@
+import io
+import re
+import tempfile
+import unittest
+
+import app
+
+
+def findall_actors(actor):
+    # The actor extraction of generate_program_element before parse_actors
+    names = []
+    if len(actor) > 0:
+        for name in [part + ")" for part in actor.split(') - ')]:
+            actor_name = re.findall(r"(.*?)\(.*?\)", name)
+            if len(actor_name) > 0:
+                if len(actor_name[0].strip()) > 0:
+                    names.append(actor_name[0].strip())
+            else:
+                names.append(name)
+    return tuple(names)
+
+
+ROW = {
+    'broadcast_id': '1001', 'tvchannel_id': '42', 'starttime': '2020-01-31 20:15:00',
+    'endtime': '2020-01-31 21:45:00', 'tvshow_length': '90', 'primetime': '1', 'category_id': '3',
+    'age_marker': '12', 'title': 'Tatort - Folge', 'subtitle': 'Abschied / Teil 1',
+    'comment_long': 'Kommissar <Muster> & Co.', 'genreid': '7', 'sequence': '12', 'tvd_total_value': '3',
+    'country': 'D|A|CH', 'year': '2019', 'moderator': 'Anne Will|Zweite Moderatorin',
+    'studio_guest': 'Gast A|Gast B', 'regisseur': 'Regie Eins|Regie Zwei',
+    'actor': 'Hans Muster (Kommissar) - (Nur Rolle) - Ohne Rolle - Erika (Ärztin (alt)) -   (Leer) - Letzter (x)',
+    'image_big': 'http://www.epgdata.com/images/1.jpg',
+}
+
+# Rendered by generate_program_element before parse_names/parse_actors
+PROGRAMME = (
+    '\t<programme channel="42" start="20200131201500 +0100" stop="20200131214500 +0100">\n'
+    '\t\t<title lang="de">Tatort - Folge</title>\n'
+    '\t\t<sub-title lang="de">Abschied / Teil 1</sub-title>\n'
+    '\t\t<desc lang="de">Kommissar &lt;Muster&gt; &amp; Co.</desc>\n'
+    '\t\t<credits>\n'
+    '\t\t\t<director>Regie Eins</director>\n'
+    '\t\t\t<director>Regie Zwei</director>\n'
+    '\t\t\t<actor>Hans Muster</actor>\n'
+    '\t\t\t<actor>Ohne Rolle - Erika</actor>\n'
+    '\t\t\t<actor>Letzter</actor>\n'
+    '\t\t\t<presenter>Anne Will</presenter>\n'
+    '\t\t\t<presenter>Zweite Moderatorin</presenter>\n'
+    '\t\t\t<guest>Gast A</guest>\n'
+    '\t\t\t<guest>Gast B</guest>\n'
+    '\t\t</credits>\n'
+    '\t\t<category lang="de">Spielfilm</category>\n'
+    '\t\t<category lang="de">Krimi</category>\n'
+    '\t\t<length units="minutes">90</length>\n'
+    '\t\t<episode-num system="xmltv_ns">.11.</episode-num>\n'
+    '\t\t<country>D</country>\n'
+    '\t\t<country>A</country>\n'
+    '\t\t<country>CH</country>\n'
+    '\t\t<date>2019</date>\n'
+    '\t\t<icon src="http://www.epgdata.com/images/1.jpg"/>\n'
+    '\t\t<rating>\n'
+    '\t\t\t<value>12</value>\n'
+    '\t\t</rating>\n'
+    '\t\t<star-rating>\n'
+    '\t\t\t<value>2/4</value>\n'
+    '\t\t</star-rating>\n'
+    '\t\t<premiere>Premiere</premiere>\n'
+    '\t</programme>\n'
+)
+
+# The same row with only an actor without a name: an empty <credits/>, no <country>
+PROGRAMME_EMPTY_CREDITS = PROGRAMME[:PROGRAMME.index('\t\t<credits>')] + '\t\t<credits/>\n' \
+    + PROGRAMME[PROGRAMME.index('\t\t<category'):PROGRAMME.index('\t\t<country>')] \
+    + PROGRAMME[PROGRAMME.index('\t\t<date>'):]
+
+
+class ParseActorsTest(unittest.TestCase):
+    CASES = [
+        '',
+        'Hans Muster (Kommissar)',
+        'Hans Muster (Kommissar) - Erika Muster (Ärztin)',
+        '(Nur Rolle)',
+        '(Nur Rolle) - Max (Max)',
+        'Ohne Rolle',
+        'A (x) - B',
+        'x) - (y',
+        '  (Leer) - b (c) - ',
+        'Name (Rolle (alt)) - Zwei (z)',
+        'A\n(x) - B (y)',
+    ]
+
+    def test_matches_findall(self):
+        for actor in self.CASES:
+            self.assertEqual(app.parse_actors(actor), findall_actors(actor), actor)
+
+    def test_names(self):
+        self.assertEqual(app.parse_names(''), ())
+        self.assertEqual(app.parse_names('D|USA'), ('D', 'USA'))
+        self.assertEqual(app.parse_names('a||b'), ('a', '', 'b'))
+
+    def test_interned(self):
+        name = ''.join(['Hans ', 'Muster'])
+        self.assertIs(app.parse_actors('Hans Muster (Kommissar)')[0], app.parse_names(name)[0])
+
+
+class ProgrammeElementTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.app = app.App(INPUT_PATH=self.tmp.name, CACHE_PATH=self.tmp.name, TVDB=False)
+        self.app.timeoffset = '+0100'
+        self.app.channel_ids = {'42'}
+        self.app.category_map = {'3': 'Spielfilm'}
+        self.app.genre_map = {'7': 'Krimi'}
+
+    def tearDown(self):
+        self.app.episode_cache.close()
+        self.tmp.cleanup()
+
+    def render(self, **values):
+        record = app.ProgrammeRecord()
+        for name, value in dict(ROW, **values).items():
+            setattr(record, name, value)
+        f = io.StringIO()
+        self.app.generate_program_element(record).writexml(f, "\t", "\t", "\n")
+        return f.getvalue()
+
+    def test_unchanged(self):
+        self.assertEqual(self.render(), PROGRAMME)
+
+    def test_unchanged_empty_credits(self):
+        self.assertEqual(self.render(actor='(Nur Rolle)', regisseur='', moderator='', studio_guest='', country=''),
+                         PROGRAMME_EMPTY_CREDITS)
+
+    def test_repeated(self):
+        # Memoized results render the same on every use
+        self.assertEqual(self.render(), self.render())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import datetime
+import hashlib
+import http.server
+import io
+import os
+import tempfile
+import threading
+import unittest
+import urllib.parse
+import zipfile
+
+import app
+
+INCLUDES = {
+    'channel_y.xml': '<?xml version="1.0" encoding="UTF-8"?>\n<channel>\n'
+                     '<data><ch0>Kanal</ch0><ch1>Kanal</ch1><ch4>42</ch4></data>\n</channel>\n',
+    'genre.xml': '<?xml version="1.0" encoding="UTF-8"?>\n<genre>\n<data><g0>7</g0><g1>Krimi</g1></data>\n</genre>\n',
+    'category.xml': '<?xml version="1.0" encoding="UTF-8"?>\n<category>\n'
+                    '<data><ca0>3</ca0><ca1>Spielfilm</ca1></data>\n</category>\n',
+}
+
+
+def package(files):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as package_zip:
+        for name, content in sorted(files.items()):
+            package_zip.writestr(name, content)
+    return data.getvalue()
+
+
+def day_file(date):
+    rows = ''.join('<data><d0>{0}</d0><d2>42</d2><d4>{1} {0:02d}:00:00</d4><d5>{1} {0:02d}:30:00</d5>'
+                   '<d19>Titel {0}</d19></data>\n'.format(hour, date.strftime('%Y-%m-%d')) for hour in range(24))
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<pack>\n{}</pack>\n'.format(rows)
+
+
+class StandIn(http.server.ThreadingHTTPServer):
+    # epgdata.com with ETag/If-None-Match, Range/If-Range and failures on demand
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.packages = {}
+        self.requests = []
+        self.fail = []
+        self.truncate = []
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        key = 'include' if query['action'] == 'sendInclude' else query['dayOffset']
+        self.server.requests.append((key, self.client_address[1], dict(self.headers)))
+
+        if key in self.server.fail:
+            self.server.fail.remove(key)
+            return self.send_empty(503)
+        if key not in self.server.packages:
+            return self.send_empty(404)
+        body = self.server.packages[key]
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            return self.send_empty(304, etag)
+
+        start = 0
+        if self.headers.get('Range') is not None and self.headers.get('If-Range') == etag:
+            start = int(self.headers['Range'][len('bytes='):].split('-')[0])
+            if start >= len(body):
+                return self.send_empty(416, etag)
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Type', 'application/x-zip-compressed')
+        self.send_header('ETag', etag)
+        if start:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body)))
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+        if key in self.server.truncate:
+            # The connection drops after half of the body
+            self.server.truncate.remove(key)
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body[start:])
+
+    def send_empty(self, status, etag=None):
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class FetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmp.name, 'input')
+        os.makedirs(self.input_path)
+        self.server = StandIn()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.date = datetime.datetime.now()
+        self.day_filename = '{0}_{0}_de_qy.xml'.format(self.date.strftime('%Y%m%d'))
+        self.server.packages['include'] = package(INCLUDES)
+        self.server.packages['0'] = package({self.day_filename: day_file(self.date)})
+
+        self.app = app.App(INPUT_PATH=self.input_path, CACHE_PATH=os.path.join(self.tmp.name, 'cache'),
+                           URL='127.0.0.1:{}'.format(self.server.server_address[1]),
+                           FETCH_WORKERS=1, BACKOFF=0, TVDB=False)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.app.episode_cache.close()
+        self.tmp.cleanup()
+
+    def requests(self, key):
+        return [(port, headers) for request_key, port, headers in self.server.requests if request_key == key]
+
+    def test_fetch(self):
+        self.server.fail.append('0')
+        self.app.fetch_all([0, 1])
+
+        for filename in INCLUDES:
+            self.assertTrue(os.path.exists(os.path.join(self.input_path, filename)))
+        with open(os.path.join(self.input_path, self.day_filename), encoding='utf-8') as f:
+            self.assertEqual(f.read(), day_file(self.date))
+        self.assertEqual(self.app.manifest.days(), [os.path.join(self.input_path, self.day_filename)])
+        # 503 retried, 404 (no package yet) not
+        self.assertEqual(len(self.requests('0')), 2)
+        self.assertEqual(len(self.requests('1')), 1)
+        self.assertEqual(self.app.report.counters['fetch_retries'], 1)
+        # One keep-alive connection for all requests of the single download thread
+        self.assertEqual(len(set(port for key, port, headers in self.server.requests)), 1)
+        self.assertEqual(os.listdir(self.app.downloads.path), [])
+
+    def test_truncated_resumed(self):
+        self.server.truncate.append('0')
+        self.app.fetch_all([0])
+
+        with open(os.path.join(self.input_path, self.day_filename), encoding='utf-8') as f:
+            self.assertEqual(f.read(), day_file(self.date))
+        first, second = self.requests('0')
+        body = self.server.packages['0']
+        self.assertNotIn('Range', first[1])
+        self.assertEqual(second[1]['Range'], 'bytes={}-'.format(len(body) // 2))
+        self.assertEqual(second[1]['If-Range'], '"{}"'.format(hashlib.sha1(body).hexdigest()))
+        self.assertEqual(self.app.report.counters['fetch_resumed'], 1)
+        self.assertEqual(self.app.downloads.get(self.date.strftime('%Y%m%d'))['sha1'],
+                         hashlib.sha1(body).hexdigest())
+        self.assertFalse(os.path.exists(self.app.downloads.spool_path(self.date.strftime('%Y%m%d'))))
+
+    def test_complete_spool_restarted(self):
+        # A spool left complete by an earlier run: the server refuses the range
+        key = self.date.strftime('%Y%m%d')
+        body = self.server.packages['0']
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        with open(self.app.downloads.spool_path(key), 'wb') as f:
+            f.write(body)
+        self.app.downloads.update(key, partial={'etag': etag, 'last_modified': None})
+        self.app.fetch_all([0])
+
+        with open(os.path.join(self.input_path, self.day_filename), encoding='utf-8') as f:
+            self.assertEqual(f.read(), day_file(self.date))
+        first, second = self.requests('0')
+        self.assertEqual(first[1]['Range'], 'bytes={}-'.format(len(body)))
+        self.assertNotIn('Range', second[1])
+        self.assertNotIn('fetch_retries', self.app.report.counters)
+        self.assertEqual(self.app.downloads.get(key)['sha1'], hashlib.sha1(body).hexdigest())
+        self.assertIsNone(self.app.downloads.get(key)['partial'])
+        self.assertFalse(os.path.exists(self.app.downloads.spool_path(key)))
+
+    def test_include_not_modified(self):
+        self.app.fetch_all([])
+        channels = os.path.join(self.input_path, 'channel_y.xml')
+        os.utime(channels, (0, 0))
+
+        self.app.fetch_all([])
+        (first, _), (second, headers) = self.requests('include')
+        self.assertEqual(headers['If-None-Match'], '"{}"'.format(hashlib.sha1(self.server.packages['include']).hexdigest()))
+        self.assertEqual(self.app.report.counters['packages_not_modified'], 1)
+        # Not extracted again
+        self.assertEqual(os.stat(channels).st_mtime, 0)
+
+    def test_include_unchanged(self):
+        # A server without conditional requests: the same content is not extracted again
+        self.app.fetch_all([])
+        channels = os.path.join(self.input_path, 'channel_y.xml')
+        os.utime(channels, (0, 0))
+        self.app.downloads.update('include', etag=None)
+
+        self.app.fetch_all([])
+        self.assertEqual(self.app.report.counters['packages_unchanged'], 1)
+        self.assertEqual(os.stat(channels).st_mtime, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import datetime
+import itertools
+import os
+import tempfile
+import unittest
+
+import app
+
+
+def programme(channel, start, stop, title, broadcast_id=''):
+    # (key, text) as written by FragmentWriter; start and stop as HHMM on
+    # 2020-01-31, or on the next day after a "+"
+    def xmltv(value):
+        date = '20200201' if value.startswith('+') else '20200131'
+        return '{}{}00 +0100'.format(date, value.lstrip('+'))
+    start, stop = xmltv(start), xmltv(stop)
+    duration = datetime.datetime.strptime(stop[:14], '%Y%m%d%H%M%S') \
+        - datetime.datetime.strptime(start[:14], '%Y%m%d%H%M%S')
+    minutes = int(duration.total_seconds()) // 60
+    text = ('\t<programme channel="{}" start="{}" stop="{}">\n'
+            '\t\t<title lang="de">{}</title>\n'
+            '\t\t<length units="minutes">{}</length>\n'
+            '\t</programme>\n').format(channel, start, stop, title, minutes)
+    return (channel, start, stop, broadcast_id), text
+
+
+class MergeProgrammesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def fragment(self, name, programmes):
+        # A fragment of a day file, sorted like generate_program_data
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w', encoding='utf-8') as f, open(path + '.keys', 'w', encoding='utf-8') as keys:
+            for key, text in sorted(programmes):
+                f.write(text)
+                keys.write('\t'.join(key) + '\n')
+        return path
+
+    def merge(self, *days):
+        self.stats = {'duplicates': 0, 'overlaps': 0}
+        paths = [self.fragment('day{}.frag'.format(i), programmes) for i, programmes in enumerate(days)]
+        return list(app.merge_programmes(paths, self.stats))
+
+    def titles(self, programmes):
+        return [text.split('<title lang="de">')[1].split('<')[0] for key, text in programmes]
+
+    def test_without_broadcast_id(self):
+        # Rows without d0 are only duplicates with the same start and stop
+        merged = self.merge([programme('42', '2000', '2100', 'A'), programme('42', '2100', '2200', 'B'),
+                             programme('42', '2200', '2300', 'C')],
+                            [programme('42', '2100', '2200', 'B')])
+        self.assertEqual(self.titles(merged), ['A', 'B', 'C'])
+        self.assertEqual(self.stats, {'duplicates': 1, 'overlaps': 0})
+
+    def test_midnight(self):
+        # Both day files hold the programme around midnight, the second one
+        # with a corrected stop
+        merged = self.merge([programme('42', '2200', '2330', 'A', '1'), programme('42', '2330', '+0030', 'B', '2')],
+                            [programme('42', '2330', '+0040', 'B', '2'), programme('42', '+0040', '+0200', 'C', '3')])
+        self.assertEqual(self.titles(merged), ['A', 'B', 'C'])
+        self.assertEqual(merged[1], programme('42', '2330', '+0030', 'B', '2'))
+        self.assertIn('<length units="minutes">60</length>', merged[1][1])
+        self.assertEqual(self.stats, {'duplicates': 1, 'overlaps': 0})
+
+    def test_cut(self):
+        merged = self.merge([programme('42', '2000', '2100', 'A', '1'), programme('42', '2030', '2130', 'B', '2')])
+        self.assertEqual(merged, [programme('42', '2000', '2030', 'A', '1'), programme('42', '2030', '2130', 'B', '2')])
+        self.assertIn('<length units="minutes">30</length>', merged[0][1])
+        self.assertEqual(self.stats, {'duplicates': 0, 'overlaps': 1})
+
+    def test_inner_dropped(self):
+        merged = self.merge([programme('42', '2000', '2200', 'A', '1'), programme('42', '2030', '2100', 'B', '2'),
+                             programme('42', '2200', '2300', 'C', '3')])
+        self.assertEqual(self.titles(merged), ['A', 'C'])
+        self.assertEqual(merged[0], programme('42', '2000', '2200', 'A', '1'))
+        self.assertEqual(self.stats, {'duplicates': 0, 'overlaps': 1})
+
+    def test_same_start_dropped(self):
+        merged = self.merge([programme('42', '2000', '2100', 'A', '1'), programme('42', '2000', '2130', 'B', '2')])
+        self.assertEqual(self.titles(merged), ['A'])
+        self.assertEqual(self.stats, {'duplicates': 0, 'overlaps': 1})
+
+    def test_channels(self):
+        # Broadcast ids and overlaps count per channel
+        merged = self.merge([programme('42', '2000', '2100', 'A', '1'), programme('43', '2000', '2100', 'B', '1'),
+                             programme('43', '2030', '2130', 'C', '2')])
+        self.assertEqual(self.titles(merged), ['A', 'B', 'C'])
+        self.assertEqual(merged[1], programme('43', '2000', '2030', 'B', '1'))
+        self.assertEqual(self.stats, {'duplicates': 0, 'overlaps': 1})
+
+    def test_file_order(self):
+        days = [
+            [programme('42', '2200', '2330', 'A', '1'), programme('42', '2330', '+0030', 'B', '2'),
+             programme('43', '2300', '+0100', 'X', '9')],
+            [programme('42', '2330', '+0030', 'B', '2'), programme('42', '+0030', '+0200', 'C', ''),
+             programme('43', '+0000', '+0200', 'Y', '')],
+            [programme('42', '+0100', '+0300', 'D', '4'), programme('43', '+0100', '+0200', 'Y', '')],
+        ]
+        results = [self.merge(*order) for order in itertools.permutations(days)]
+        for merged in results[1:]:
+            self.assertEqual(merged, results[0])
+        self.assertEqual(self.titles(results[0]), ['A', 'B', 'C', 'D', 'X', 'Y'])
+        self.assertEqual([key[0] for key, text in results[0]], ['42'] * 4 + ['43'] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import datetime
+import gzip
+import hashlib
+import http.client
+import os
+import tempfile
+import unittest
+
+import app
+
+
+def guide(now):
+    # Two channels with a programme running now and one tomorrow each
+    def xmltv(time):
+        return time.strftime('%Y%m%d%H%M%S +0100')
+    parts = ['<?xml version="1.0" ?>\n<tv generator-info-name="EPGData2XMLTV">\n']
+    for channel_id, name in [('42', 'Kanal Eins'), ('43', 'Kanal Zwei')]:
+        parts.append('\t<channel id="{}">\n\t\t<display-name lang="de">{}</display-name>\n\t</channel>\n'.format(
+            channel_id, name))
+    for channel_id in ['42', '43']:
+        for start in [now - datetime.timedelta(minutes=30), now + datetime.timedelta(days=1)]:
+            parts.append('\t<programme channel="{}" start="{}" stop="{}">\n'
+                         '\t\t<title lang="de">Titel {}</title>\n\t</programme>\n'.format(
+                             channel_id, xmltv(start), xmltv(start + datetime.timedelta(hours=1)), channel_id))
+    parts.append('</tv>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+class GuideServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'epg.xml')
+        self.data = guide(datetime.datetime.now())
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.etag = '"{}"'.format(hashlib.sha1(self.data).hexdigest())
+        self.server = app.GuideServer(self.path, '127.0.0.1', 0)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.httpd.shutdown()
+        self.server.httpd.server_close()
+        self.tmp.cleanup()
+
+    def get(self, path='/epg.xml', **headers):
+        conn = http.client.HTTPConnection(*self.server.httpd.server_address[:2], timeout=10)
+        try:
+            conn.request('GET', path, headers=dict((name.replace('_', '-'), value) for name, value in headers.items()))
+            response = conn.getresponse()
+            return response.status, response.headers, response.read()
+        finally:
+            conn.close()
+
+    def test_guide(self):
+        status, headers, body = self.get()
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+        self.assertEqual(headers['ETag'], self.etag)
+        self.assertEqual(self.get('/other.xml')[0], 404)
+
+    def test_not_modified(self):
+        status, headers, body = self.get(If_None_Match=self.etag)
+        self.assertEqual((status, body), (304, b''))
+        self.assertEqual(headers['ETag'], self.etag)
+
+        # The gzip encoded guide has an ETag of its own
+        status, headers, body = self.get(Accept_Encoding='gzip')
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['ETag'], self.etag[:-1] + '-gz"')
+        self.assertEqual(gzip.decompress(body), self.data)
+        status, headers, body = self.get(Accept_Encoding='gzip', If_None_Match=self.etag[:-1] + '-gz"')
+        self.assertEqual((status, body), (304, b''))
+        self.assertEqual(self.get(Accept_Encoding='gzip', If_None_Match=self.etag)[0], 200)
+        self.assertEqual(self.get(If_None_Match=self.etag[:-1] + '-gz"')[0], 200)
+
+    def test_range(self):
+        status, headers, body = self.get(Range='bytes=10-19')
+        self.assertEqual((status, body), (206, self.data[10:20]))
+        self.assertEqual(headers['Content-Range'], 'bytes 10-19/{}'.format(len(self.data)))
+        status, headers, body = self.get(Range='bytes=-6', If_Range=self.etag)
+        self.assertEqual((status, body), (206, b'</tv>\n'))
+
+        status, headers, body = self.get(Range='bytes={}-'.format(len(self.data)))
+        self.assertEqual((status, body), (416, b''))
+        self.assertEqual(headers['Content-Range'], 'bytes */{}'.format(len(self.data)))
+
+        # A changed guide is sent whole
+        status, headers, body = self.get(Range='bytes=10-19', If_Range='"changed"')
+        self.assertEqual((status, body), (200, self.data))
+
+    def test_channels(self):
+        by_name = self.get('/epg.xml?channels=Kanal%20Zwei')
+        by_id = self.get('/epg.xml?channels=43')
+        self.assertEqual(by_name[0], 200)
+        self.assertEqual(by_name[2], by_id[2])
+        self.assertIn(b'<channel id="43">', by_id[2])
+        self.assertNotIn(b'"42"', by_id[2])
+        self.assertEqual(by_id[2].count(b'<programme'), 2)
+        self.assertEqual(by_id[1]['ETag'], '"{}"'.format(hashlib.sha1(by_id[2]).hexdigest()))
+
+        status, headers, body = self.get('/epg.xml?channels=Kanal%20Eins,43')
+        self.assertEqual(body.count(b'<channel'), 2)
+        self.assertEqual(body.count(b'<programme'), 4)
+
+        status, headers, body = self.get('/epg.xml?channels=43&hours=12')
+        self.assertEqual(body.count(b'<programme'), 1)
+
+    def test_invalid_hours(self):
+        for hours in ['nan', 'inf', '-inf', '-1', '0', '337', 'x']:
+            self.assertEqual(self.get('/epg.xml?hours=' + hours)[0], 400, hours)
+        # The server is still serving
+        status, headers, body = self.get('/epg.xml?hours=336')
+        self.assertEqual(status, 200)
+        self.assertEqual(body.count(b'<programme'), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
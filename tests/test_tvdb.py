@@ -0,0 +1,188 @@
+import os
+import shutil
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+import app
+
+INCLUDES = {
+    'channel_y.xml': '<?xml version="1.0" encoding="UTF-8"?>\n<channel>\n'
+                     '<data><ch0>Kanal</ch0><ch1>Kanal</ch1><ch4>42</ch4></data>\n</channel>\n',
+    'genre.xml': '<?xml version="1.0" encoding="UTF-8"?>\n<genre>\n</genre>\n',
+    'category.xml': '<?xml version="1.0" encoding="UTF-8"?>\n<category>\n</category>\n',
+}
+
+# (title, subtitle, sequence) of the programmes, one per hour
+PROGRAMMES = [
+    ('Serie A - Staffel', 'Folge 1 / Teil 1', '1'),
+    ('Serie A - Staffel', 'Folge 2', '2'),
+    ('Serie A', 'Folge 1 / Teil 2', '1'),
+    ('Serie A', 'Folge 1', '1'),
+    ('Serie A', 'Folge 9', '9'),
+    ('Serie B', 'Folge 1', '1'),
+    ('Serie B', 'Folge 1', '1'),
+    ('Unbekannt', 'Pilot', '1'),
+    ('Unbekannt', 'Pilot', '1'),
+    ('Kaputt', 'Folge 1', '1'),
+    ('Kaputt', 'Folge 1', '1'),
+    ('Film', '', '0'),
+]
+
+
+def day_file(date, programmes):
+    rows = []
+    for hour, (title, subtitle, sequence) in enumerate(programmes):
+        values = {'d0': '{}{:02d}'.format(date.replace('-', ''), hour), 'd2': '42',
+                  'd4': '{} {:02d}:00:00'.format(date, hour), 'd5': '{} {:02d}:59:00'.format(date, hour),
+                  'd7': '59', 'd9': '0', 'd19': title, 'd20': subtitle, 'd26': sequence, 'd30': '0'}
+        for tag in ['d10', 'd16', 'd21', 'd25', 'd32', 'd33', 'd34', 'd35', 'd36', 'd37', 'd40']:
+            values.setdefault(tag, '')
+        rows.append('<data>{}</data>\n'.format(''.join('<{0}>{1}</{0}>'.format(tag, value)
+                                                       for tag, value in values.items())))
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<pack>\n{}</pack>\n'.format(''.join(rows))
+
+
+class ShowNotFound(Exception):
+    pass
+
+
+class TvdbError(Exception):
+    pass
+
+
+class TvdbStandIn:
+    # tvdb_api.Tvdb over SERIES; every lookup is recorded in CALLS as
+    # (series, episode), or (series, None) for a series that is not found
+    SERIES = {
+        'Serie A': {'Folge 1': (1, 1), 'Folge 2': (1, 2)},
+        'Serie B': {'Folge 1': (3, 4)},
+        'Kaputt': {'Folge 1': (1, 1)},
+    }
+    CALLS = []
+    ERRORS = set()
+
+    def __init__(self, apikey=None, **kwargs):
+        self.config = {}
+
+    def __getitem__(self, series_name):
+        if series_name not in self.SERIES:
+            self.CALLS.append((series_name, None))
+            raise ShowNotFound(series_name)
+        return ShowStandIn(series_name)
+
+
+class ShowStandIn:
+
+    def __init__(self, series_name):
+        self.series_name = series_name
+
+    def search(self, episode_name, key=None):
+        TvdbStandIn.CALLS.append((self.series_name, episode_name))
+        if self.series_name in TvdbStandIn.ERRORS:
+            raise TvdbError(self.series_name)
+        episode = TvdbStandIn.SERIES[self.series_name].get(episode_name)
+        if episode is None:
+            return []
+        return [{'airedSeason': episode[0], 'airedEpisodeNumber': episode[1]}]
+
+
+TVDB_API = types.SimpleNamespace(Tvdb=TvdbStandIn, tvdb_shownotfound=ShowNotFound, tvdb_error=TvdbError)
+
+
+class EnrichEpisodesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.tmp.name, 'input')
+        self.cache_path = os.path.join(self.tmp.name, 'cache')
+        os.makedirs(self.input_path)
+        for filename, content in INCLUDES.items():
+            with open(os.path.join(self.input_path, filename), 'w', encoding='utf-8') as f:
+                f.write(content)
+        # The same programmes on two days
+        for date in ['2020-01-31', '2020-02-01']:
+            filename = '{0}_{0}_de_qy.xml'.format(date.replace('-', ''))
+            with open(os.path.join(self.input_path, filename), 'w', encoding='utf-8') as f:
+                f.write(day_file(date, PROGRAMMES))
+        self.channelfilter = os.path.join(self.tmp.name, 'channelfilter')
+        with open(self.channelfilter, 'w', encoding='utf-8') as f:
+            f.write('Kanal\n')
+
+        patcher = mock.patch('app.tvdb', return_value=TVDB_API)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        TvdbStandIn.CALLS = []
+        TvdbStandIn.ERRORS = set()
+        self.apps = []
+
+    def tearDown(self):
+        for guide in self.apps:
+            guide.episode_cache.close()
+        self.tmp.cleanup()
+
+    def convert(self):
+        guide = app.App(INPUT_PATH=self.input_path, CACHE_PATH=self.cache_path, CHANNELFILTER=self.channelfilter)
+        self.apps.append(guide)
+        guide.load_includes()
+        guide.convert()
+        return guide
+
+    def convert_again(self):
+        # After the first run ended; the fragments are removed, so the day
+        # files are converted again
+        self.apps.pop().episode_cache.close()
+        TvdbStandIn.CALLS = []
+        shutil.rmtree(os.path.join(self.cache_path, 'fragments'))
+        return self.convert()
+
+    def test_one_lookup_per_episode(self):
+        guide = self.convert()
+        self.assertEqual(sorted(TvdbStandIn.CALLS), [
+            ('Kaputt', 'Folge 1'),
+            ('Serie A', 'Folge 1'), ('Serie A', 'Folge 2'), ('Serie A', 'Folge 9'),
+            ('Serie B', 'Folge 1'),
+            ('Unbekannt', None),
+        ])
+        self.assertEqual(guide.report.counters['tvdb_queries'], 6)
+        self.assertEqual(guide.episode_cache.get('Serie A', 'Folge 1'), (1, 1))
+        self.assertEqual(guide.episode_cache.get('Serie B', 'Folge 1'), (3, 4))
+        self.assertEqual(guide.episode_cache.get('Serie A', 'Folge 9'), (None, None))
+
+    def test_show_not_found_cached(self):
+        guide = self.convert()
+        self.assertEqual(guide.episode_cache.get('Unbekannt', 'Pilot'), (None, None))
+        self.assertIsNone(guide.lookup_episode('Unbekannt', 'Pilot'))
+
+        guide = self.convert_again()
+        self.assertEqual(guide.episodes[('Unbekannt', 'Pilot')], (None, None))
+        self.assertIsNone(guide.lookup_episode('Unbekannt', 'Pilot'))
+        self.assertEqual(TvdbStandIn.CALLS, [])
+
+    def test_failed_not_queried_again(self):
+        # Kaputt airs twice a day; its lookup fails once in enrich_episodes
+        # and is not repeated while the programmes are converted
+        TvdbStandIn.ERRORS.add('Kaputt')
+        guide = self.convert()
+        self.assertEqual(TvdbStandIn.CALLS.count(('Kaputt', 'Folge 1')), 1)
+        self.assertEqual(guide.failed_episodes, {('Kaputt', 'Folge 1')})
+        self.assertEqual(guide.report.counters['tvdb_errors'], 1)
+        self.assertIsNone(guide.lookup_episode('Kaputt', 'Folge 1'))
+        self.assertEqual(TvdbStandIn.CALLS.count(('Kaputt', 'Folge 1')), 1)
+        # Not cached, a later run tries again
+        self.assertIsNone(guide.episode_cache.get('Kaputt', 'Folge 1'))
+
+    def test_second_run(self):
+        self.convert()
+        self.assertGreater(len(TvdbStandIn.CALLS), 0)
+
+        guide = self.convert_again()
+        self.assertEqual(guide.report.counters['files_converted'], 2)
+        self.assertEqual(TvdbStandIn.CALLS, [])
+        self.assertNotIn('tvdb_queries', guide.report.counters)
+        self.assertIsNone(guide.t)
+
+
+if __name__ == '__main__':
+    unittest.main()